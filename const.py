@@ -1,3 +1,6 @@
 
 VM_POWER_STATE_OFF = "poweredOff"
 VM_POWER_STATE_ON = "poweredOn"
+
+# Environment variable pointing at a file to keep the vSphere session cookie in, see VSphere.__init__
+SESSION_FILE_ENV_VAR = "VI_SESSIONFILE"
@@ -0,0 +1,51 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from support_functions import power_functions
+
+# Don't hammer vCenter with more than this many operations at once, whatever the caller asks for.
+MAX_WORKERS_LIMIT = 60
+
+
+def run_for_each_vm(v_sphere, function, vmw_vms, max_workers=32):
+    """
+    Runs function(v_sphere, vmw_vm) for each of the given VMs, in parallel.
+
+    Almost all the time spent on a VM operation is waiting on SOAP calls, so threads are enough to get them
+    overlapping, and the whole batch takes about as long as the slowest VM rather than the sum of them all.
+
+    :param VSphere v_sphere:
+    :param function function: one of the per-VM functions in support_functions, e.g. power_functions.restart_vm_hard
+    :param list(vim.VirtualMachine) vmw_vms:
+    :param int max_workers: (optional) how many VMs to work on at once. Capped at MAX_WORKERS_LIMIT.
+    :return: the exception raised for each VM, or None if it succeeded
+    :rtype dict: {vim.VirtualMachine: Exception or None}
+    """
+    results = {}
+    if not vmw_vms:
+        return results
+
+    with ThreadPoolExecutor(max_workers=min(len(vmw_vms), max_workers, MAX_WORKERS_LIMIT)) as executor:
+        futures = {executor.submit(function, v_sphere, vmw_vm): vmw_vm for vmw_vm in vmw_vms}
+
+        for future in as_completed(futures):
+            vmw_vm = futures[future]
+            error = future.exception()
+            if error:
+                v_sphere.logger.error(f" VSphere: {function.__name__} failed for {vmw_vm}: {str(error)}")
+
+            results[vmw_vm] = error
+
+    return results
+
+
+def batch_power_on(v_sphere, vmw_vms, max_workers=32):
+    """
+    Powers on the given VMs in parallel, returning once all of them have an OS responding (or have failed).
+
+    :param VSphere v_sphere:
+    :param list(vim.VirtualMachine) vmw_vms:
+    :param int max_workers: (optional) how many VMs to work on at once.
+    :return: the exception raised for each VM, or None if it succeeded
+    :rtype dict: {vim.VirtualMachine: Exception or None}
+    """
+    return run_for_each_vm(v_sphere, power_functions.power_on_vm_and_wait_for_os, vmw_vms, max_workers)
@@ -1,12 +1,169 @@
-import time
+import asyncio
+import codecs
+import re
+import threading
 
 import requests
+import urllib3
 from pyVmomi import vim
+from requests.adapters import HTTPAdapter
 
 from exceptions import VMWareGuestOSException, VMWareGuestOSTimeoutException, \
     VMWareGuestOSProcessUnknownException, VMWareBadState, VMWareGuestOSProcessAmbiguousResultException, \
     VMWareGuestOSProcessBadOutputException
 
+# Guest files are served over HTTPS by the VM's host, usually with a self signed certificate which we don't verify.
+# Share one session so that repeated downloads from the same host reuse the connection instead of a new TLS handshake.
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=16))
+
+# Maximum number of simultaneous connections for async downloads of guest files
+ASYNC_CONNECTION_LIMIT = 32
+
+# Guest output files are read this many bytes at a time
+OUTPUT_CHUNK_SIZE = 8192
+
+# How much of an unexpected output we keep to put in the error message
+OUTPUT_ERROR_PREFIX_CHARS = 4096
+
+
+def get_guest_output_http_session():
+    """
+    Get an aiohttp session for downloading guest output files with check_guest_output().
+
+    Note that this has to be created, used and closed within the same event loop, e.g. `async with` it around an
+    asyncio.gather() of GuestOSInterface.run_command_and_check_result_async calls.
+
+    :rtype aiohttp.ClientSession:
+    """
+    # Only needed for the async API, so we don't make everybody install it
+    import aiohttp
+
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=ASYNC_CONNECTION_LIMIT, ssl=False))
+
+
+async def check_guest_output(url, command, http_session=None):
+    """
+    Download a guest output file and check it for the command's success outputs, without blocking the event loop.
+
+    The file is read a chunk at a time and we stop downloading as soon as we see a success output.
+
+    :param str url: URL given to us by InitiateFileTransferFromGuest
+    :param GuestOSCommand command: The command whose output this is.
+    :param aiohttp.ClientSession http_session: (optional) session to download with. If not given, one is created just
+        for this download.
+    :return: if the output shows the command was successful
+    :raises VMWareGuestOSProcessAmbiguousResultException: blank output, which may or may not mean success
+    :raises VMWareGuestOSProcessBadOutputException: the output didn't contain any of the success outputs
+    """
+    if http_session is None:
+        async with get_guest_output_http_session() as new_session:
+            return await check_guest_output(url, command, new_session)
+
+    async with http_session.get(url) as resp:
+        _check_output_response_status(resp.status, resp.reason, command)
+
+        decoder = codecs.getincrementaldecoder(resp.charset or 'utf-8')(errors='replace')
+        output_checker = _OutputChecker(command)
+
+        async for chunk in resp.content.iter_chunked(OUTPUT_CHUNK_SIZE):
+            if output_checker.feed(decoder.decode(chunk)):
+                return
+
+        output_checker.feed(decoder.decode(b'', final=True))
+        output_checker.finish()
+
+
+def _check_output_response_status(status_code, reason, command):
+    """
+    Make sure that the VM's host actually gave us the output file.
+
+    :raises VMWareBadState: if we didn't get an HTTP 200
+    """
+    if not status_code == 200:
+        raise VMWareBadState(f"Didn't receive an appropriate response from VMWare when attempting to retrieve "
+                             f"the output file {command.output_file_location} for {command}. "
+                             f"Expected an HTTP 200 response, but received a {status_code}: {reason}")
+
+
+class _OutputChecker:
+    """
+    Looks through the output of a command which didn't exit successfully, to see if it actually worked.
+
+    The output is fed in a chunk at a time, so that we can stop reading as soon as we see one of the command's success
+    outputs, rather than downloading the whole thing first. Only the start of the output is kept, for the error message.
+    """
+
+    def __init__(self, command):
+        """
+        :param GuestOSCommand command:
+        """
+        self.command = command
+        self._blank_expected = '' in command.success_outputs
+
+        # Keep enough of the end of the last chunk to catch a success output split across two chunks
+        self._overlap = max([len(output) for output in command.success_outputs] + [1]) - 1
+        self._tail = ''
+        self._prefix = ''
+        self._truncated = False
+        self._seen_output = False
+
+    def feed(self, chunk):
+        """
+        :param str chunk: the next piece of the output
+        :return: True if we've seen enough to know the command was successful
+        :rtype bool:
+        """
+        # The cmd output adds new lines etc. So we strip them out to avoid issues.
+        chunk = chunk.replace("\r", "").replace("\n", "")
+        if not self._truncated:
+            self._prefix += chunk
+            if len(self._prefix) > OUTPUT_ERROR_PREFIX_CHARS:
+                self._prefix = self._prefix[:OUTPUT_ERROR_PREFIX_CHARS]
+                self._truncated = True
+
+        if chunk.strip():
+            self._seen_output = True
+
+            # Any (non blank) output counts if a blank output is expected
+            if self._blank_expected:
+                return True
+
+        window = self._tail + chunk
+        if self.command.success_pattern and self.command.success_pattern.search(window):
+            return True  # success
+
+        self._tail = window[-self._overlap:] if self._overlap else ''
+        return False
+
+    def finish(self):
+        """
+        Call once all the output has been fed in without a success output being seen.
+
+        :raises VMWareGuestOSProcessAmbiguousResultException: blank output, which may or may not mean success
+        :raises VMWareGuestOSProcessBadOutputException: the output didn't contain any of the success outputs
+        """
+        # If we got the file, check it's an expected output. If it isn't, append an error.
+        # This is complicated by blank results (sometimes expected) and complex results which we want to
+        # look for the success message contained in.
+
+        # Check for expected blank output
+        if not self._seen_output and self._blank_expected:
+            raise VMWareGuestOSProcessAmbiguousResultException(
+                f"{self.command} did not exit successfully, but a blank output was found, and a blank output "
+                "can be expected. This could mean that the program_command failed silently."
+            )
+
+        file_contents = self._prefix.strip(" ")
+        if self._truncated:
+            file_contents += "..."
+
+        raise VMWareGuestOSProcessBadOutputException(
+            f"{self.command} did not exit successfully, and an unexpected result was recorded in the output file: "
+            f"{file_contents}"
+        )
+
 
 class GuestOSCommand:
 
@@ -15,7 +172,7 @@ class GuestOSCommand:
                  program_command,
                  description='',
                  output_file_location='',
-                 success_outputs=list,
+                 success_outputs=None,
                  timeout_seconds=120):
         """
         Data class for holding information about a command to be run on the Guest OS by the GuestOSInterface.
@@ -31,15 +188,170 @@ class GuestOSCommand:
         self.program_command = program_command
         self.description = description
         self.output_file_location = output_file_location
-        self.success_outputs = success_outputs
+        self.success_outputs = success_outputs or []
         self.timeout_seconds = timeout_seconds
 
+        # One compiled pattern matching any of the (non blank) success outputs, so that output can be checked in a
+        # single pass rather than once per success output.
+        non_blank_outputs = [output for output in self.success_outputs if output]
+        self.success_pattern = None
+        if non_blank_outputs:
+            self.success_pattern = re.compile('|'.join(re.escape(output) for output in non_blank_outputs))
+
     def __str__(self):
         if self.description:
             return f"GuestOSCommand: {self.description}"
         return f"GuestOSCommand: {self.program_path} {self.program_command}"
 
 
+class _PendingProcess:
+    """
+    A PID somebody is waiting on, and what the poller found out about it.
+    """
+
+    def __init__(self):
+        self.finished = threading.Event()
+        self.process_info = None
+        self.error = None
+
+
+class GuestProcessPoller:
+    """
+    Watches processes running in one guest OS (as one user) and works out when they've exited.
+
+    ListProcessesInGuest takes a list of PIDs, so rather than every command polling its own PID, all the commands
+    waiting on the same VM register with a shared poller. A single background thread then asks about every pending PID
+    in one call, and hands the results back to whoever was waiting. Once nobody is waiting the poller is dropped, and
+    the next command gets a new one.
+
+    Most commands finish in well under a second, so we check on a new PID straight away and then back off from
+    INITIAL_POLL_INTERVAL_SECONDS up to MAX_POLL_INTERVAL_SECONDS for the long running ones.
+    """
+    INITIAL_POLL_INTERVAL_SECONDS = 0.2
+    MAX_POLL_INTERVAL_SECONDS = 5
+    POLL_BACKOFF_FACTOR = 1.4
+
+    _pollers = {}
+    _pollers_lock = threading.Lock()
+
+    @classmethod
+    def get_poller(cls, vsphere, vm_obj, login_credentials):
+        """
+        Get the shared poller for this VM and guest user, creating it if needed.
+
+        :param VSphere vsphere:
+        :param vim.VirtualMachine vm_obj:
+        :param vim.vm.guest.NamePasswordAuthentication login_credentials:
+        :rtype GuestProcessPoller:
+        """
+        # Key on the stub (i.e. the connection) as well as the moId, as managed objects on different vCenters can
+        # share a moId and still compare equal.
+        key = (vm_obj._stub, vm_obj._moId, login_credentials.username)
+        with cls._pollers_lock:
+            poller = cls._pollers.get(key)
+            if poller is None:
+                poller = cls(key, vsphere, vm_obj, login_credentials)
+                cls._pollers[key] = poller
+
+            return poller
+
+    def __init__(self, key, vsphere, vm_obj, login_credentials):
+        self._key = key
+        self.vsphere = vsphere
+        self.vm_obj = vm_obj
+        self.login_credentials = login_credentials
+
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._thread = None
+        self._new_pid = threading.Event()
+
+    def wait_for_exit(self, pid, timeout_seconds):
+        """
+        Block until the process with the given PID has exited, or timeout_seconds pass.
+
+        :param int pid: Process ID in the guest OS
+        :param int timeout_seconds:
+        :return: the process info reported by VMWare, or None if we timed out
+        :rtype vim.vm.guest.ProcessManager.ProcessInfo:
+        :raises VMWareGuestOSException: if VMWare didn't tell us anything about the process
+        """
+        pending = _PendingProcess()
+        with self._lock:
+            self._pending[pid] = pending
+            self._new_pid.set()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._poll, name=f"GuestProcessPoller-{self.vm_obj}",
+                                                daemon=True)
+                self._thread.start()
+
+        finished = pending.finished.wait(timeout_seconds)
+
+        with self._lock:
+            self._pending.pop(pid, None)
+
+        if not finished:
+            return None
+
+        if pending.error:
+            raise pending.error
+
+        return pending.process_info
+
+    def _poll(self):
+        """
+        Background loop: ask about every pending PID at once until nobody is waiting any more.
+        """
+        poll_interval = self.INITIAL_POLL_INTERVAL_SECONDS
+        while True:
+            with self._pollers_lock, self._lock:
+                if not self._pending:
+                    self._thread = None
+                    if self._pollers.get(self._key) is self:
+                        del self._pollers[self._key]
+                    return
+                pids = list(self._pending)
+                self._new_pid.clear()
+
+            try:
+                # Ask the VSphere every time, so that we use the current session if it's reconnected since last time
+                process_manager = self.vsphere.process_manager
+                process_list = process_manager.ListProcessesInGuest(self.vm_obj, self.login_credentials, pids)
+                error = None
+            except Exception as e:
+                process_list = []
+                error = VMWareGuestOSException(f"Could not list processes in guest: {str(e)}")
+
+            process_infos = {process_info.pid: process_info for process_info in process_list}
+
+            with self._lock:
+                for pid in pids:
+                    pending = self._pending.get(pid)
+                    if pending is None:
+                        continue
+
+                    process_info = process_infos.get(pid)
+
+                    # It is possible that we don't get any info back, in this case, we give up looking
+                    if process_info is None:
+                        pending.error = error or VMWareGuestOSException(
+                            f"No process info returned by the GuestOS for PID {pid}"
+                        )
+                    # Here we look for an exit code. If there isn't one, the process is still running
+                    elif process_info.exitCode is None:
+                        continue
+
+                    pending.process_info = process_info
+                    pending.finished.set()
+                    del self._pending[pid]
+
+            # A new PID cuts the wait short, so that it gets checked straight away as well.
+            if self._new_pid.wait(poll_interval):
+                poll_interval = self.INITIAL_POLL_INTERVAL_SECONDS
+            else:
+                poll_interval = min(poll_interval * self.POLL_BACKOFF_FACTOR, self.MAX_POLL_INTERVAL_SECONDS)
+
+
 class GuestOSInterface:
     """
         Interface for talking to the guest OS. Masks the complicated inner workings of VMWare.
@@ -49,12 +361,28 @@ class GuestOSInterface:
         self.vsphere = vsphere
         self.vmname = vmname
         self.vm_obj = vsphere.get_vmw_obj_by_name(vim.VirtualMachine, vmname)
-        self.process_manager = vsphere.get_process_manager()
-        self.file_manager = vsphere.get_file_manager()
         self.login_credentials = vim.vm.guest.NamePasswordAuthentication(
             username=username, password=password
         )
 
+        # Building pyvmomi data objects is surprisingly slow, so we reuse one spec for every command we run.
+        self._program_spec = vim.vm.guest.ProcessManager.ProgramSpec()
+        self._program_spec_lock = threading.Lock()
+
+    @property
+    def process_manager(self):
+        """
+        Shared with every other interface on the same VSphere, and only looked up when first needed.
+        """
+        return self.vsphere.process_manager
+
+    @property
+    def file_manager(self):
+        """
+        Shared with every other interface on the same VSphere, and only looked up when first needed.
+        """
+        return self.vsphere.file_manager
+
     def run_command_and_check_result(self, command):
         """
         Rus a GuestOSCommand on self.vm_obj. If the exit code reports a success, all is well. Otherwise, tries to
@@ -64,53 +392,80 @@ class GuestOSInterface:
         :param GuestOSCommand command:
         :return:
         """
+        if self._run_command_and_wait(command):
+            return
 
-        pid = self.run_command(command.program_path, command.program_command, command.output_file_location)
+        url = self._get_output_file_url(command)
 
-        command_running = True
-        check_output = False
+        with _SESSION.get(url, verify=False, stream=True) as resp:
+            _check_output_response_status(resp.status_code, resp.reason, command)
 
-        if pid == 0:
-            raise VMWareGuestOSException(f"No Process ID returned running {command}")
+            # Without a charset, requests won't decode the chunks for us
+            if resp.encoding is None:
+                resp.encoding = 'utf-8'
 
-        '''
-            Make sure that the program_command has finished before we move on to the next one
-        '''
-        timeout_counter = 0
-        while command_running:
+            output_checker = _OutputChecker(command)
+            for chunk in resp.iter_content(chunk_size=OUTPUT_CHUNK_SIZE, decode_unicode=True):
+                if output_checker.feed(chunk):
+                    return
 
-            # Default to breaking the loop as there are several exit conditions and only 1 continue.
-            command_running = False
+        output_checker.finish()
 
-            process_list = self.process_manager.ListProcessesInGuest(self.vm_obj,
-                                                                     self.login_credentials,
-                                                                     [pid])
+    async def run_command_and_check_result_async(self, command, http_session=None):
+        """
+        Coroutine version of run_command_and_check_result, so that lots of commands can be run at once with
+        asyncio.gather(). The SOAP calls are handed off to the event loop's executor, and the output file (if we need
+        it) is downloaded with aiohttp so that downloads overlap rather than queueing up behind each other.
 
-            # It is possible that we don't get any info back, in this case, we give up looking and check output
-            if len(process_list) == 0:
-                raise VMWareGuestOSException(
-                    f"No process info returned by the GuestOS. Can't check status of {command}"
-                )
+        :param GuestOSCommand command:
+        :param aiohttp.ClientSession http_session: (optional) share one between calls to reuse connections to the
+            host, see get_guest_output_http_session()
+        :return:
+        """
+        loop = asyncio.get_running_loop()
 
-            process_info = process_list.pop()
+        if await loop.run_in_executor(None, self._run_command_and_wait, command):
+            return
 
-            # Here we look for an exit code. If there isn't one, the process is running
-            if process_info.exitCode is not None:
+        url = await loop.run_in_executor(None, self._get_output_file_url, command)
+        await check_guest_output(url, command, http_session)
 
-                # 0 is the "all good" response.
-                if process_info.exitCode == 0:
-                    return
+    def _run_command_and_wait(self, command):
+        """
+        Run the command and wait for it to finish.
+
+        :param GuestOSCommand command:
+        :return: True if the command exited successfully, False if it exited with an error
+        :rtype bool:
+        """
+        pid = self.run_command(command.program_path, command.program_command, command.output_file_location)
+
+        if pid == 0:
+            raise VMWareGuestOSException(f"No Process ID returned running {command}")
+
+        '''
+            Make sure that the program_command has finished before we move on to the next one
+        '''
+        poller = GuestProcessPoller.get_poller(self.vsphere, self.vm_obj, self.login_credentials)
+        process_info = poller.wait_for_exit(pid, command.timeout_seconds)
 
-            elif timeout_counter > command.timeout_seconds:
-                raise VMWareGuestOSTimeoutException(f"{command} did not finish in < {command.timeout_seconds}s")
+        if process_info is None:
+            raise VMWareGuestOSTimeoutException(f"{command} did not finish in < {command.timeout_seconds}s")
 
-            # If there's no exit code, and we didn't time out, keep waiting.
-            timeout_counter += 5
-            time.sleep(5)
+        # 0 is the "all good" response.
+        return process_info.exitCode == 0
 
+    def _get_output_file_url(self, command):
+        """
+        Get a URL we can download the command's output file from.
+
+        :param GuestOSCommand command:
+        :return: URL of the file on the VM's host
+        :rtype str:
+        """
         '''
-            If we didn't return earlier, something went wrong. We now try to check the output of the process, this
-            relies on the output being redirected to file.
+            If we're here, something went wrong. We now try to check the output of the process, this relies on the
+            output being redirected to file.
         '''
         # If we've flagged the program_command for a check but we have no output redirect, we'll need to note this...
         if not command.output_file_location:
@@ -135,36 +490,7 @@ class GuestOSInterface:
             raise FileNotFoundError(f"Couldn't locate file {command.output_file_location} when running {command} - "
                                     f"VMWare didn't return a URL")
 
-        resp = requests.get(url, verify=False)
-
-        if not resp.status_code == 200:
-            raise VMWareBadState(f"Didn't receive an appropriate response from VMWare when attempting to retrieve "
-                                 f"the output file {command.output_file_location} for {command}. "
-                                 f"Expected an HTTP 200 response, but received a {resp.status_code}: {resp.reason}")
-
-        # The cmd output adds new lines etc. So we strip them out to avoid issues.
-        file_contents = resp.text.replace("\r", "").replace("\n", "").strip(" ")
-
-        # If we got the file, check it's an expected output. If it isn't, append an error.
-        # This is complicated by blank results (sometimes expected) and complex results which we want to
-        # look for the success message contained in.
-
-        # Check for expected blank output
-        if file_contents.strip() == '' and '' in command.success_outputs:
-            raise VMWareGuestOSProcessAmbiguousResultException(
-                f"{command} did not exit successfully, but a blank output was found, and a blank output "
-                "can be expected. This could mean that the program_command failed silently."
-            )
-
-        # Deal with text output
-        for expected_result in command.success_outputs:
-            if expected_result in file_contents:
-                return  # success
-
-        raise VMWareGuestOSProcessBadOutputException(
-            f"{command} did not exit successfully, and an unexpected result was recorded in the output file: "
-            f"{file_contents}"
-        )
+        return url
 
     def run_command(self, path, command, output_file_location=''):
         """
@@ -182,15 +508,15 @@ class GuestOSInterface:
 
         print(f"Running {path} {command}")
 
-        program_spec = vim.vm.guest.ProcessManager.ProgramSpec(
-            programPath=path,
-            arguments=command
-        )
+        # The spec is shared between calls, so make sure nobody else changes it before it's sent.
+        with self._program_spec_lock:
+            self._program_spec.programPath = path
+            self._program_spec.arguments = command
 
-        try:
-            pid = self.process_manager.StartProgramInGuest(self.vm_obj, self.login_credentials, program_spec)
-        except Exception as e:
-            raise VMWareGuestOSException(f"Could not run program_command in guest: '{command}' Exception: {str(e)}")
+            try:
+                pid = self.process_manager.StartProgramInGuest(self.vm_obj, self.login_credentials, self._program_spec)
+            except Exception as e:
+                raise VMWareGuestOSException(f"Could not run program_command in guest: '{command}' Exception: {str(e)}")
 
         print(f"Command sent to {self.vmname} and returned PID {pid}")
 
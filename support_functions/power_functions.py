@@ -1,10 +1,229 @@
+import threading
 import time
+from collections import OrderedDict
 
-from pyVmomi import vmodl
+from pyVmomi import vim, vmodl
 
-from support_functions import task_functions
+from support_functions import task_functions, property_functions
 from const import VM_POWER_STATE_ON
-from exceptions import VMWareTimeout, VMWareBadState, VMWareGuestOSException, VMWareGuestOSTimeoutException
+from exceptions import VMWareTimeout, VMWareBadState, VMWareGuestOSException, VMWareGuestOSTimeoutException, \
+    VMWareConnectionException
+
+# vCenter copes with a limited number of power on tasks in flight at once, so cap them across all threads.
+MAX_CONCURRENT_POWER_ONS = 60
+_power_on_slots = threading.BoundedSemaphore(MAX_CONCURRENT_POWER_ONS)
+
+# How long we wait for VMs to do things (wall clock), and how often we refresh the managed object while we wait
+SOFT_POWER_OFF_TIMEOUT_SECONDS = 12 * 60
+TOOLS_TIMEOUT_SECONDS = 20 * 60
+REFRESH_SECONDS = 120
+
+# Upper bound on how long a single WaitForUpdatesEx call by the PowerStateWatcher blocks server side, so it notices
+# when nobody is subscribed any more. Also how long we'll wait for vCenter to first tell us a VM's power state.
+POWER_STATE_MAX_WAIT_SECONDS = 30
+
+# Every VM watched costs a filter on vCenter, and we get told about all their power changes, so we stop watching VMs
+# nobody has asked about for a while, and never watch more than this many at once (least recently asked about go first).
+POWER_STATE_IDLE_SECONDS = 10 * 60
+MAX_WATCHED_VMS = 200
+
+
+class _WatchedVM:
+    """
+    A VM somebody wants to know the power state of, and what the watcher has been told about it.
+    """
+
+    def __init__(self, property_filter):
+        self.property_filter = property_filter
+        self.known = threading.Event()
+        self.power_state = None
+        self.last_asked = time.monotonic()
+
+
+class PowerStateWatcher:
+    """
+    Keeps track of VMs' power states by having vCenter tell us when they change, rather than asking every time.
+
+    Each VM subscribed to gets a filter on its runtime.powerState in one PropertyCollector, and a single background
+    thread sits in WaitForUpdatesEx on that collector, writing whatever comes back into a dict. Checking a VM's power
+    state is then a dict lookup rather than a SOAP call.
+
+    Note that the first check of a VM costs more than just asking for the power state would: a CreateFilter call, then
+    a wait for the background thread to hear back from vCenter. It pays off when the same VMs are checked repeatedly.
+    VMs which haven't been asked about for POWER_STATE_IDLE_SECONDS are dropped, as are the least recently asked about
+    once more than MAX_WATCHED_VMS are being watched.
+    """
+
+    def __init__(self, service_instance):
+        self.service_instance = service_instance
+        self._collector = service_instance.content.propertyCollector.CreatePropertyCollector()
+
+        self._lock = threading.Lock()
+        self._watched = OrderedDict()
+        self._version = ''
+        self._thread = None
+        self.error = None
+
+    def subscribe(self, vmw_vm):
+        """
+        Start watching the power state of a VM, if we aren't already.
+
+        :param vim.VirtualMachine vmw_vm:
+        :rtype _WatchedVM:
+        :raises Exception: whatever stopped the watcher working, if it has stopped.
+        """
+        with self._lock:
+            if self.error:
+                raise self.error
+
+            watched = self._watched.get(vmw_vm)
+            if watched:
+                watched.last_asked = time.monotonic()
+                self._watched.move_to_end(vmw_vm)
+                return watched
+
+            obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=vmw_vm, skip=False)
+            property_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine,
+                                                                       pathSet=['runtime.powerState'], all=False)
+            filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=[property_spec])
+
+            watched = _WatchedVM(self._collector.CreateFilter(filter_spec, True))
+            self._watched[vmw_vm] = watched
+
+            while len(self._watched) > MAX_WATCHED_VMS:
+                _, oldest = self._watched.popitem(last=False)
+                _destroy_filter(oldest.property_filter)
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._watch, name=f"PowerStateWatcher-{self.service_instance}",
+                                                daemon=True)
+                self._thread.start()
+
+            return watched
+
+    def unsubscribe(self, vmw_vm):
+        """
+        Stop watching the power state of a VM. Subscribing again later gets the current power state from vCenter.
+
+        :param vim.VirtualMachine vmw_vm:
+        :return:
+        """
+        with self._lock:
+            watched = self._watched.pop(vmw_vm, None)
+            if watched:
+                _destroy_filter(watched.property_filter)
+
+    def get_power_state(self, vmw_vm, timeout_seconds=POWER_STATE_MAX_WAIT_SECONDS):
+        """
+        Get the power state of a VM, subscribing to it if need be. The first time, this waits for vCenter to send the
+        current power state over (see the class notes on what that costs), after that it's answered straight away.
+
+        :param vim.VirtualMachine vmw_vm:
+        :param int timeout_seconds: (optional) how long to wait for vCenter to first tell us the power state
+        :return: the power state, e.g. "poweredOn"
+        :rtype str:
+        :raises VMWareTimeout: if vCenter didn't tell us the power state in time
+        """
+        watched = self.subscribe(vmw_vm)
+        if not watched.known.wait(timeout_seconds):
+            raise VMWareTimeout(f"Waited {timeout_seconds} seconds to find out the power state of {vmw_vm}")
+
+        if self.error:
+            raise self.error
+
+        return watched.power_state
+
+    def close(self):
+        """
+        Stop watching everything. Anyone still waiting to find out a power state gets an error straight away.
+        Destroying the collector also destroys all its filters, and the background thread stops when its
+        WaitForUpdatesEx call fails.
+
+        :return:
+        """
+        with self._lock:
+            if not self.error:
+                self.error = VMWareConnectionException(f"Stopped watching power states on {self.service_instance}")
+
+            for watched in self._watched.values():
+                watched.known.set()
+
+            self._watched = OrderedDict()
+
+        try:
+            self._collector.DestroyPropertyCollector()
+        except Exception:
+            pass
+
+    def _watch(self):
+        """
+        Background loop: write down every power state change vCenter tells us about, until nobody is subscribed.
+        """
+        while True:
+            with self._lock:
+                self._drop_idle()
+                if not self._watched:
+                    self._thread = None
+                    return
+                version = self._version
+
+            try:
+                update_set = self._collector.WaitForUpdatesEx(
+                    version,
+                    vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=POWER_STATE_MAX_WAIT_SECONDS)
+                )
+            except Exception as e:
+                self._fail(e)
+                return
+
+            # None means POWER_STATE_MAX_WAIT_SECONDS passed without any change
+            if update_set is None:
+                continue
+
+            with self._lock:
+                self._version = update_set.version
+                for filter_set in update_set.filterSet:
+                    for obj_set in filter_set.objectSet:
+                        watched = self._watched.get(obj_set.obj)
+                        if watched is None:
+                            continue
+
+                        for change in obj_set.changeSet:
+                            if change.name == 'runtime.powerState':
+                                watched.power_state = change.val
+
+                        watched.known.set()
+
+    def _fail(self, error):
+        """
+        The collector has stopped working (the session went away, or we were closed), so pass the error on to anyone
+        waiting. The watcher can't be used after this.
+        """
+        with self._lock:
+            self.error = self.error or error
+            for watched in self._watched.values():
+                watched.known.set()
+
+            self._watched = OrderedDict()
+            self._thread = None
+
+    def _drop_idle(self):
+        """
+        Stop watching VMs nobody has asked about for POWER_STATE_IDLE_SECONDS. Call with self._lock held.
+        """
+        cutoff = time.monotonic() - POWER_STATE_IDLE_SECONDS
+        for vmw_vm in [vmw_vm for vmw_vm, watched in self._watched.items() if watched.last_asked < cutoff]:
+            _destroy_filter(self._watched.pop(vmw_vm).property_filter)
+
+
+def _destroy_filter(property_filter):
+    """
+    Destroy a filter we no longer need, ignoring failures - if the session has gone, so has the filter.
+    """
+    try:
+        property_filter.Destroy()
+    except Exception:
+        pass
 
 
 def power_on_vm_and_wait_for_os(v_sphere, vmw_vm):
@@ -19,8 +238,9 @@ def power_on_vm_and_wait_for_os(v_sphere, vmw_vm):
 
     v_sphere.logger.info(f"Trying to power on {vmw_vm}")
 
-    task = vmw_vm.PowerOn()
-    task_functions.wait_for_task_complete(v_sphere, task, timeout_seconds=60)
+    with _power_on_slots:
+        task = vmw_vm.PowerOn()
+        task_functions.wait_for_task_complete(v_sphere, task, timeout_seconds=60)
 
     wait_for_vmware_tools_response(v_sphere, vmw_vm)
 
@@ -44,27 +264,18 @@ def power_off_vm_soft(v_sphere, vmw_vm):
 
     else:
         # Manually check the VM shut down as requested because VMWare didn't give us a Task.
-        time.sleep(20)
-
-        wait_count = 0
-        refreshes = 0
-        while vmw_vm.summary.runtime.powerState == VM_POWER_STATE_ON:
-            time.sleep(5)
-            v_sphere.logger.info("VM to shut down, current status {}".format(vmw_vm.guest.toolsRunningStatus))
-            wait_count += 1
+        powered_off = _wait_for_vm_property(
+            v_sphere,
+            vmw_vm,
+            'summary.runtime.powerState',
+            lambda power_state: power_state != VM_POWER_STATE_ON,
+            timeout_seconds=SOFT_POWER_OFF_TIMEOUT_SECONDS
+        )
 
-            # If we waited 2 minutes, try to get a new Managed Object from the Service Instance
-            if wait_count > 24:
-                # If we've already done this several times times, give up
-                if refreshes >= 5:
-                    msg = "  VM is still powered on and won't shut off! Help!"
-                    v_sphere.logger.error(msg)
-                    raise VMWareTimeout(msg)
-
-                v_sphere.logger.info(
-                    "Waited 2 minutes for tools. Refreshing VM Object from Service Instance. Might be bugged.")
-                vmw_vm = v_sphere.get_vmw_obj_by_uuid(vmw_vm.config.uuid)
-                refreshes += 1
+        if not powered_off:
+            msg = "  VM is still powered on and won't shut off! Help!"
+            v_sphere.logger.error(msg)
+            raise VMWareTimeout(msg)
 
 
 def power_off_vm_hard(v_sphere, vmw_vm):
@@ -152,7 +363,6 @@ def try_to_soft_restart(v_sphere, vmw_vm):
     :raises vim.fault.VimFault: VMware shit the bed.
     """
 
-    wait_time = 30
     attempted_reboots = 0
     max_reboot_attempts = 5
     last_encountered_exception = None
@@ -165,12 +375,18 @@ def try_to_soft_restart(v_sphere, vmw_vm):
             v_sphere.logger.info('  **  Successful reboot.')
             return
 
-        except vmodl.fault.SystemError as last_encountered_exception:
+        except vmodl.fault.SystemError as e:
+            # Python forgets the "as" name at the end of the except block, so hang on to it for re-raising later.
+            last_encountered_exception = e
             if 'invalid fault' not in last_encountered_exception.msg.lower():
                 v_sphere.logger.error(f"  **  System error - Not due to Invalid Fault: {str(last_encountered_exception)}")
                 raise last_encountered_exception
 
-        attempted_reboots += 1
+        if attempted_reboots >= max_reboot_attempts:
+            break
+
+        # Back off: 5, 10, 20, 40 seconds between attempts
+        wait_time = min(5 * 2 ** (attempted_reboots - 1), 60)
         v_sphere.logger.info(f"  **  Invalid Fault encountered - rebooting after {wait_time} seconds")
         time.sleep(wait_time)
 
@@ -204,34 +420,40 @@ def vmw_vm_check_soft_restarted_ok(v_sphere, vmw_vm):
     # So for the too fast issue: We issue the command then look for VMWare Tools instead of the OS, because windows
     # can come back so quickly that we miss the reboot, but Tools always takes a few seconds.
     # For the second issue, we return False to the calling method to handle
-    is_rebooting = False
-    for x in range(0, 120):
-        if vmw_vm.guest.toolsRunningStatus != "guestToolsRunning":
-            msg = "  **  VM started rebooting!"
-            v_sphere.logger.info(msg)
-            is_rebooting = True
-            break
-
-        time.sleep(1)
+    values = property_functions.wait_for_property_values(
+        v_sphere,
+        vmw_vm,
+        ['guest.toolsRunningStatus'],
+        lambda vm_values: vm_values.get('guest.toolsRunningStatus') != "guestToolsRunning",
+        timeout_seconds=120
+    )
 
-    if not is_rebooting:
+    if values.get('guest.toolsRunningStatus') == "guestToolsRunning":
         msg = "  !!  VM refused to reboot!"
         v_sphere.logger.info(msg)
         raise VMWareBadState(msg)
 
+    msg = "  **  VM started rebooting!"
+    v_sphere.logger.info(msg)
+
     msg = "  **  VM soft restart request in progress. Waiting for tools to come back up"
     v_sphere.logger.info(msg)
 
-    counter = 0
-    while vmw_vm.guest.guestState != "running":
-        msg = "  **  Waiting for VM to finish restarting"
+    # vCenter pushes guestState changes to us, we just wake up once a minute to log that we're still waiting.
+    values = property_functions.wait_for_property_values(
+        v_sphere,
+        vmw_vm,
+        ['guest.guestState'],
+        lambda vm_values: vm_values.get('guest.guestState') == "running",
+        timeout_seconds=1800,
+        max_wait_seconds=60
+    )
+    guest_state = values.get('guest.guestState')
+
+    if guest_state != "running":
+        msg = f"  !!  Waited for VM to restart for 30 min with no change! :( Guest state is still '{guest_state}'"
         v_sphere.logger.info(msg)
-        time.sleep(1)
-        counter += 1
-        if counter > 1800:
-            msg = "  !!  Waited for VM to restart for 30 min with no change! :("
-            v_sphere.logger.info(msg)
-            raise VMWareGuestOSTimeoutException(msg)
+        raise VMWareGuestOSTimeoutException(msg)
 
     msg = "  **  VM restart finished!"
     v_sphere.logger.info(msg)
@@ -257,21 +479,50 @@ def wait_for_vmware_tools_response(v_sphere, vmw_vm):
     """
 
     v_sphere.logger.info("Waiting for VMWare Tools")
-    wait_count = 0
-    refreshes = 0
-    while vmw_vm.guest.toolsRunningStatus != "guestToolsRunning":
-        time.sleep(5)
-        v_sphere.logger.info("Still waiting for tools, current status {}".format(vmw_vm.guest.toolsRunningStatus))
-        wait_count += 1
-
-        # If we waited 2 minutes, try to get a new Managed Object from the Service Instance
-        if wait_count > 24:
-            # If we've already done this 10 times, give up
-            if refreshes >= 10:
-                msg = "  !! Reboot program_command issued but VMWare Tools did not come up within 20 minutes! Help!"
-                v_sphere.logger.error(msg)
-                raise VMWareTimeout(msg)
-
-            v_sphere.logger.info("Waited 2 minutes for tools. Refreshing VM Object from Service Instance. Might be bugged.")
-            vmw_vm = v_sphere.get_vmw_obj_by_uuid(vmw_vm.config.uuid)
-            refreshes += 1
+    tools_running = _wait_for_vm_property(
+        v_sphere,
+        vmw_vm,
+        'guest.toolsRunningStatus',
+        lambda tools_status: tools_status == "guestToolsRunning",
+        timeout_seconds=TOOLS_TIMEOUT_SECONDS
+    )
+
+    if not tools_running:
+        msg = "  !! Reboot program_command issued but VMWare Tools did not come up within 20 minutes! Help!"
+        v_sphere.logger.error(msg)
+        raise VMWareTimeout(msg)
+
+
+def _wait_for_vm_property(v_sphere, vmw_vm, path, condition, timeout_seconds):
+    """
+    Wait for a property of a VM to satisfy a condition, working around pyvmomi/vSphere sometimes not updating the
+    managed object: every REFRESH_SECONDS without success we get a fresh managed object from the service instance and
+    carry on waiting on that instead.
+
+    :param VSphere v_sphere:
+    :param vim.VirtualMachine vmw_vm:
+    :param str path: property path to watch, e.g. 'guest.toolsRunningStatus'
+    :param function condition: called with the latest value of the property. Return True to stop waiting.
+    :param int timeout_seconds: total time to wait, across all refreshes
+    :return: whether the condition was met in time
+    :rtype bool:
+    """
+    deadline = time.monotonic() + timeout_seconds
+    while True:
+        remaining = deadline - time.monotonic()
+        values = property_functions.wait_for_property_values(
+            v_sphere,
+            vmw_vm,
+            [path],
+            lambda vm_values: condition(vm_values.get(path)),
+            timeout_seconds=max(1, min(REFRESH_SECONDS, remaining))
+        )
+        if path in values and condition(values[path]):
+            return True
+
+        if time.monotonic() >= deadline:
+            return False
+
+        v_sphere.logger.info(f"Waited {REFRESH_SECONDS} seconds for {path} to change, currently {values.get(path)}. "
+                             "Refreshing VM Object from Service Instance. Might be bugged.")
+        vmw_vm = v_sphere.get_vmw_obj_by_uuid(vmw_vm.config.uuid, force_refresh=True)
@@ -0,0 +1,68 @@
+import time
+
+from pyVmomi import vmodl
+
+# Upper bound on how long a single WaitForUpdatesEx call blocks server side, so we still get to log progress.
+MAX_WAIT_SECONDS = 60
+
+
+def wait_for_property_values(v_sphere, vmw_obj, path_set, condition, timeout_seconds=None,
+                             max_wait_seconds=MAX_WAIT_SECONDS):
+    """
+    Watch some properties of a managed object until they satisfy a condition, or we run out of time.
+
+    Rather than sleeping and re-reading the properties (a SOAP call each time), we put a PropertyCollector filter on
+    them and let vCenter block until one of them changes. The first call always returns the current values, so if the
+    condition is already met we return straight away.
+
+    :param VSphere v_sphere:
+    :param vim.ManagedObject vmw_obj: the object to watch, e.g. a vim.VirtualMachine or vim.Task
+    :param list(str) path_set: property paths to watch, e.g. ['guest.toolsRunningStatus']
+    :param function condition: called with a dict of {path: latest value} whenever something changes. Return True
+        to stop waiting.
+    :param int timeout_seconds: (optional) the maximum number of seconds to wait. Default is no timeout.
+    :param int max_wait_seconds: (optional) how long each call to vCenter may block for.
+    :return: the latest value of each property. If the condition isn't met by these, we timed out.
+    :rtype dict:
+    """
+    deadline = time.monotonic() + timeout_seconds if timeout_seconds else None
+    values = {}
+
+    # Use our own collector so that our filter and update versions don't get mixed up with anyone else's.
+    collector = v_sphere.get_service_instance().content.propertyCollector.CreatePropertyCollector()
+    try:
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=vmw_obj, skip=False)
+        property_spec = vmodl.query.PropertyCollector.PropertySpec(type=type(vmw_obj), pathSet=path_set, all=False)
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=[property_spec])
+        collector.CreateFilter(filter_spec, True)
+
+        version = ''
+        while True:
+            wait_seconds = max_wait_seconds
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return values
+                wait_seconds = max(1, min(wait_seconds, int(remaining)))
+
+            update_set = collector.WaitForUpdatesEx(
+                version,
+                vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=wait_seconds)
+            )
+
+            # None means wait_seconds passed without any change
+            if update_set is None:
+                v_sphere.logger.info(f" VSphere: Still waiting on {vmw_obj}, current values: {values}")
+                continue
+
+            version = update_set.version
+            for filter_set in update_set.filterSet:
+                for obj_set in filter_set.objectSet:
+                    for change in obj_set.changeSet:
+                        values[change.name] = change.val
+
+            if condition(values):
+                return values
+    finally:
+        # Destroying the collector also destroys the filter we put on it.
+        collector.DestroyPropertyCollector()
@@ -1,26 +1,180 @@
+import threading
+from collections import OrderedDict
+
 from pyVmomi import vim, vmodl
 
+from exceptions import VMWareInvalidInputException
+
+# How many container views we keep open on vCenter for reuse, and how many objects we ask for per page of results.
+MAX_CACHED_VIEWS = 32
+RETRIEVE_PAGE_SIZE = 100
+
+# Properties fetched by collect_properties when the caller doesn't ask for any. Asking for everything ('all') makes
+# vCenter serialise dozens of KB per object, so we only fetch what the rest of the wrapper actually uses.
+DEFAULT_PATHS = {
+    vim.VirtualMachine: ['name', 'config.uuid', 'guest.toolsRunningStatus', 'summary.runtime.powerState'],
+    vim.HostSystem: ['name'],
+    vim.Datastore: ['name'],
+    vim.Folder: ['name'],
+    vim.Network: ['name'],
+}
+
+# {(service instance stub, container, frozenset of vimtypes): ContainerView}, least recently used first
+_container_views = OrderedDict()
+_container_views_lock = threading.Lock()
+
 
-def get_vmw_objects_of_type(service_instance, vimtype):
+def get_vmw_objects_of_type(service_instance, vimtype, path_set=None):
     """
     Returns a list of dicts with information gathered from vSphere, and the SOAP object for each result.
 
     :param class vimtype:
+    :param list path_set: (optional) properties to fetch for each object. Defaults to DEFAULT_PATHS for the vimtype.
     :return:
     :rtype [dict]: Each item in the list is a dict representing an object in vmware. The 'obj' key is the SOAP object.
     """
 
-    view = get_container_view(service_instance=service_instance, obj_type=[vimtype])
-    vmw_data = collect_properties(service_instance=service_instance, view_ref=view, obj_type=vimtype, include_mors=True)
-    view.DestroyView()  # TODO: maybe breaking
-    return vmw_data
+    view = get_cached_container_view(service_instance=service_instance, vimtype=vimtype)
+    return collect_properties(service_instance=service_instance, view_ref=view, obj_type=vimtype, path_set=path_set,
+                              include_mors=True)
+
+
+def find_vmw_obj_by_name(service_instance, vimtype, name):
+    """
+    Find an object of the given type by name. Only the names of objects are fetched from vCenter, and we stop
+    fetching as soon as we find a match.
+
+    :param vim.ServiceInstance service_instance:
+    :param class vimtype:
+    :param str name:
+    :return: the object, or None if there's no object of that type with that name
+    :rtype vim.ManagedObject:
+    """
+    view = get_cached_container_view(service_instance=service_instance, vimtype=vimtype)
+    results = iterate_properties(service_instance=service_instance, view_ref=view, obj_type=vimtype,
+                                 path_set=['name'], include_mors=True)
+    try:
+        for result in results:
+            if result.get('name') == name:
+                return result['obj']
+    finally:
+        results.close()
+
+    return None
+
+
+def fetch_properties(service_instance, vmw_obj, path_set):
+    """
+    Fetch just the given properties of a single object in one call. Reading properties off a managed object
+    fetches each one (and everything underneath it) separately, which is wasteful when only part of a big property
+    like 'config' is wanted.
+
+    :param vim.ServiceInstance service_instance:
+    :param vim.ManagedObject vmw_obj:
+    :param list path_set: properties to fetch, e.g. ['config.hardware.device']
+    :return: the value of each property requested. Unset properties are missing from the dict.
+    :rtype dict:
+    """
+    obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=vmw_obj, skip=False)
+    property_spec = vmodl.query.PropertyCollector.PropertySpec(type=type(vmw_obj), pathSet=path_set, all=False)
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=[property_spec])
+
+    for properties in _retrieve_pages(service_instance.content.propertyCollector, filter_spec, include_mors=False):
+        return properties
+
+    return {}
+
+
+def get_vmw_objects_of_types(service_instance, vimtypes, path_set=None):
+    """
+    Like get_vmw_objects_of_type, but for several types at once, using a single (cached) view and a single property
+    collection rather than one of each per type.
+
+    :param vim.ServiceInstance service_instance:
+    :param list(class) vimtypes: e.g. [vim.HostSystem, vim.Datastore]
+    :param list path_set: (optional) properties to fetch for each object. Defaults to DEFAULT_PATHS for each type.
+    :return: the objects found for each type
+    :rtype dict: {vimtype: [dict]} Each dict represents an object in vmware. The 'obj' key is the SOAP object.
+    """
+    view = get_cached_container_view(service_instance=service_instance, vimtype=vimtypes)
+    vmw_data = collect_properties(service_instance=service_instance, view_ref=view, obj_type=vimtypes,
+                                  path_set=path_set, include_mors=True)
+
+    results = {vimtype: [] for vimtype in vimtypes}
+    for properties in vmw_data:
+        for vimtype in vimtypes:
+            if isinstance(properties['obj'], vimtype):
+                results[vimtype].append(properties)
+
+    return results
+
+
+def get_cached_container_view(service_instance, vimtype, container=None):
+    """
+    Get a Container View of all objects of vimtype (or of several types), reusing one we made earlier if possible.
+
+    Creating and destroying a view costs a round trip each, so for repeated lookups we keep the most recently used
+    views open. The view is kept up to date by vCenter, so it's safe to reuse. Views pushed out of the cache are
+    destroyed, the rest are cleaned up by close_all_views() or when the session ends.
+
+    :param vim.ServiceInstance service_instance:
+    :param class vimtype: a managed object type, or a list of them
+    :param vim.ManagedEntity container: (optional) where to look. Defaults to the root folder.
+    :return: A container view ref to the discovered managed objects
+    :rtype: ContainerView
+    """
+    if not container:
+        container = service_instance.content.rootFolder
+
+    obj_types = list(vimtype) if isinstance(vimtype, list) else [vimtype]
+
+    # Key on the stub (i.e. the connection) as service instances for the same vCenter compare equal, but views only
+    # live as long as the session that made them.
+    key = (service_instance._stub, container, frozenset(obj_types))
+    with _container_views_lock:
+        view = _container_views.get(key)
+        if view is not None:
+            _container_views.move_to_end(key)
+            return view
+
+        view = get_container_view(service_instance=service_instance, obj_type=obj_types, container=container)
+        _container_views[key] = view
+
+        if len(_container_views) > MAX_CACHED_VIEWS:
+            _, oldest_view = _container_views.popitem(last=False)
+            _destroy_view(oldest_view)
+
+        return view
+
+
+def close_all_views(service_instance):
+    """
+    Destroy all the cached container views belonging to the given service instance.
+
+    :param vim.ServiceInstance service_instance:
+    :return:
+    """
+    with _container_views_lock:
+        for key in [key for key in _container_views if key[0] is service_instance._stub]:
+            _destroy_view(_container_views.pop(key))
+
+
+def _destroy_view(view):
+    """
+    Destroy a container view, ignoring failures - if the session has already gone, so has the view.
+    """
+    try:
+        view.DestroyView()
+    except Exception:
+        pass
 
 
 def get_container_view(service_instance, obj_type, container=None):
     """
     Get a vSphere Container View reference to all objects of type 'obj_type'
 
-    It is up to the caller to take care of destroying the View when no longer needed.
+    It is up to the caller to take care of destroying the View when no longer needed, or to use
+    get_cached_container_view() instead, which looks after that.
 
     Original Source: https://github.com/dnaeon/py-vconnector/blob/master/src/vconnector/core.py
     Modified for my purposes here.
@@ -55,13 +209,43 @@ def collect_properties(service_instance, view_ref, obj_type, path_set=None, incl
     Modified for my purposes here.
 
     :param pyVmomi.vim.view.* view_ref: Starting point of inventory navigation
-    :param pyVmomi.vim.* obj_type: Type of managed object
-    :param list path_set: List of properties to retrieve
+    :param pyVmomi.vim.* obj_type: Type of managed object, or a list of them
+    :param list path_set: List of properties to retrieve. Defaults to DEFAULT_PATHS for the obj_type(s).
     :param bool include_mors: If True include the managed objects refs in the result
 
     :return: A list of properties for the managed objects
     :rtype list:
+    :raises VMWareInvalidInputException: if no path_set was given and there's no default for obj_type
     """
+    return list(iterate_properties(service_instance, view_ref, obj_type, path_set, include_mors))
+
+
+def iterate_properties(service_instance, view_ref, obj_type, path_set=None, include_mors=False):
+    """
+    Generator version of collect_properties(), which yields each object's properties as they arrive, a page at a
+    time. Stop iterating early and the rest of the results are never sent over.
+
+    :param pyVmomi.vim.view.* view_ref: Starting point of inventory navigation
+    :param pyVmomi.vim.* obj_type: Type of managed object, or a list of them
+    :param list path_set: List of properties to retrieve. Defaults to DEFAULT_PATHS for the obj_type(s).
+    :param bool include_mors: If True include the managed objects refs in the result
+    :rtype generator(dict):
+    :raises VMWareInvalidInputException: if no path_set was given and there's no default for obj_type
+    """
+    obj_types = obj_type if isinstance(obj_type, list) else [obj_type]
+
+    # Identify the properties to the retrieved
+    property_specs = []
+    for vimtype in obj_types:
+        type_path_set = path_set or DEFAULT_PATHS.get(vimtype)
+        if not type_path_set:
+            raise VMWareInvalidInputException(f"No properties requested for {vimtype} and there are no defaults")
+
+        property_spec = vmodl.query.PropertyCollector.PropertySpec()
+        property_spec.type = vimtype
+        property_spec.all = False
+        property_spec.pathSet = type_path_set
+        property_specs.append(property_spec)
 
     collector = service_instance.content.propertyCollector
 
@@ -79,32 +263,48 @@ def collect_properties(service_instance, view_ref, obj_type, path_set=None, incl
     traversal_spec.type = view_ref.__class__
     obj_spec.selectSet = [traversal_spec]
 
-    # Identify the properties to the retrieved
-    property_spec = vmodl.query.PropertyCollector.PropertySpec()
-    property_spec.type = obj_type
-
-    if not path_set:
-        property_spec.all = True
-
-    property_spec.pathSet = path_set
-
     # Add the object and property specification to the
     # property filter specification
     filter_spec = vmodl.query.PropertyCollector.FilterSpec()
     filter_spec.objectSet = [obj_spec]
-    filter_spec.propSet = [property_spec]
+    filter_spec.propSet = property_specs
+
+    yield from _retrieve_pages(collector, filter_spec, include_mors)
+
+
+def _retrieve_pages(collector, filter_spec, include_mors):
+    """
+    Retrieve properties a page at a time so that vCenter isn't building one huge response, yielding a dict of
+    properties for each object as we go. If the caller stops early, the rest of the results are cancelled and never
+    sent over.
+
+    :param vmodl.query.PropertyCollector collector:
+    :param vmodl.query.PropertyCollector.FilterSpec filter_spec:
+    :param bool include_mors: If True include the managed objects refs in the result
+    :rtype generator(dict):
+    """
+    result = collector.RetrievePropertiesEx(
+        [filter_spec],
+        vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=RETRIEVE_PAGE_SIZE)
+    )
+
+    try:
+        while result:
+            for obj in result.objects:
+                properties = {}
+                for prop in obj.propSet:
+                    properties[prop.name] = prop.val
+
+                if include_mors:
+                    properties['obj'] = obj.obj
 
-    # Retrieve properties
-    props = collector.RetrieveContents([filter_spec])
+                yield properties
 
-    data = []
-    for obj in props:
-        properties = {}
-        for prop in obj.propSet:
-            properties[prop.name] = prop.val
+            if not result.token:
+                break
 
-        if include_mors:
-            properties['obj'] = obj.obj
+            result = collector.ContinueRetrievePropertiesEx(result.token)
 
-        data.append(properties)
-    return data
+    finally:
+        if result and result.token:
+            collector.CancelRetrievePropertiesEx(result.token)
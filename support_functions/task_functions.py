@@ -1,14 +1,209 @@
-import time
+import threading
 
-from pyVmomi import vim
+from pyVmomi import vim, vmodl
 
 from exceptions import VMWareTimeout
 
+# Upper bound on how long a single WaitForUpdatesEx call blocks server side, so the reaper notices when it's done.
+MAX_WAIT_SECONDS = 60
+
+TASK_FINISHED_STATES = [vim.TaskInfo.State.success, vim.TaskInfo.State.error]
+
+
+class _WatchedTask:
+    """
+    A task somebody is waiting on, and what the reaper found out about it.
+    """
+
+    def __init__(self, task, property_filter):
+        self.task = task
+        self.property_filter = property_filter
+        self.finished = threading.Event()
+        self.state = None
+        self.error = None
+
+
+class TaskReaper:
+    """
+    Waits on all the in-flight tasks for a vCenter session at once.
+
+    Each task being waited on gets a filter on its info.state in one shared PropertyCollector, and a single background
+    thread sits in WaitForUpdatesEx on that collector. Whenever any task changes state vCenter wakes that thread up,
+    and it lets whoever was waiting on the task know. This means one blocking call covers every task, however many
+    threads are waiting on them.
+    """
+    _reapers = {}
+    _reapers_lock = threading.Lock()
+
+    @classmethod
+    def get_reaper(cls, service_instance):
+        """
+        Get the shared reaper for this service instance, creating it if needed.
+
+        :param vim.ServiceInstance service_instance:
+        :rtype TaskReaper:
+        """
+        # Key on the stub (i.e. the connection) as service instances for the same vCenter compare equal.
+        key = service_instance._stub
+        with cls._reapers_lock:
+            reaper = cls._reapers.get(key)
+            if reaper is None:
+                reaper = cls(service_instance)
+                cls._reapers[key] = reaper
+
+            return reaper
+
+    @classmethod
+    def close_reaper(cls, service_instance):
+        """
+        Retire the reaper for this service instance, if there is one, e.g. because the session is going away. Anyone
+        still waiting on a task gets an error.
+
+        :param vim.ServiceInstance service_instance:
+        :return:
+        """
+        with cls._reapers_lock:
+            reaper = cls._reapers.pop(service_instance._stub, None)
+
+        if reaper:
+            reaper.close()
+
+    def __init__(self, service_instance):
+        self.service_instance = service_instance
+        self._collector = service_instance.content.propertyCollector.CreatePropertyCollector()
+
+        self._lock = threading.Lock()
+        self._watched = {}
+        self._version = ''
+        self._thread = None
+
+    def wait(self, task, timeout_seconds=None):
+        """
+        Block until the task has finished, or timeout_seconds pass.
+
+        :param vim.Task task:
+        :param int timeout_seconds: (optional) Default is no timeout.
+        :return: the final state of the task, or None if we timed out
+        :rtype vim.TaskInfo.State:
+        """
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=task, skip=False)
+        property_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.Task, pathSet=['info.state'], all=False)
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=[property_spec])
+
+        with self._lock:
+            property_filter = self._collector.CreateFilter(filter_spec, True)
+            watched = _WatchedTask(task, property_filter)
+            self._watched[property_filter] = watched
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._reap, name=f"TaskReaper-{self.service_instance}",
+                                                daemon=True)
+                self._thread.start()
+
+        finished = watched.finished.wait(timeout_seconds)
+
+        with self._lock:
+            if self._watched.pop(property_filter, None):
+                self._destroy_filter(property_filter)
+
+        if watched.error:
+            raise watched.error
+
+        if not finished:
+            return None
+
+        return watched.state
+
+    def _reap(self):
+        """
+        Background loop: wait for any watched task to change state until nobody is waiting any more.
+        """
+        while True:
+            with self._lock:
+                if not self._watched:
+                    self._thread = None
+                    return
+                version = self._version
+
+            try:
+                update_set = self._collector.WaitForUpdatesEx(
+                    version,
+                    vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=MAX_WAIT_SECONDS)
+                )
+            except Exception as e:
+                self._fail_all(e)
+                return
+
+            # None means MAX_WAIT_SECONDS passed without any change
+            if update_set is None:
+                continue
+
+            with self._lock:
+                self._version = update_set.version
+                for filter_set in update_set.filterSet:
+                    watched = self._watched.get(filter_set.filter)
+                    if watched is None:
+                        continue
+
+                    for obj_set in filter_set.objectSet:
+                        for change in obj_set.changeSet:
+                            if change.name == 'info.state':
+                                watched.state = change.val
+
+                    if watched.state in TASK_FINISHED_STATES:
+                        del self._watched[filter_set.filter]
+                        self._destroy_filter(filter_set.filter)
+                        watched.finished.set()
+
+    def _fail_all(self, error):
+        """
+        The collector has stopped working (probably the session went away), so pass the error on to everyone waiting
+        and retire this reaper.
+        """
+        with self._reapers_lock:
+            if self._reapers.get(self.service_instance._stub) is self:
+                del self._reapers[self.service_instance._stub]
+
+        with self._lock:
+            for watched in self._watched.values():
+                watched.error = error
+                watched.finished.set()
+
+            self._watched = {}
+            self._thread = None
+
+        self.close()
+
+    def close(self):
+        """
+        Destroy our collector on vCenter (which also destroys its filters). If the background thread is waiting on it,
+        its WaitForUpdatesEx call fails and it passes the error on to everyone waiting.
+
+        :return:
+        """
+        try:
+            self._collector.DestroyPropertyCollector()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _destroy_filter(property_filter):
+        """
+        Destroy a filter we no longer need, ignoring failures - if the session has gone, so has the filter.
+        """
+        try:
+            property_filter.Destroy()
+        except Exception:
+            pass
+
 
 def wait_for_task_complete(v_sphere, task, timeout_seconds=None):
     """
     Helper function, when we've triggered a VMWare task and need to sit and wait for it to be done.
 
+    Rather than sleeping and re-fetching task.info, we hand the task to the TaskReaper, which gets told by vCenter
+    as soon as the task finishes.
+
     Optionally takes a maximum amount of time to wait. Default is no timeout.
 
     :note: With no timeout set this may never end.
@@ -17,17 +212,16 @@ def wait_for_task_complete(v_sphere, task, timeout_seconds=None):
     :param int timeout_seconds: (optional) the maximum number of seconds to wait before deciding it's a lost cause
     :return: whether the task was successful
     :rtype bool:
+    :raises VMWareTimeout: if the task didn't finish within timeout_seconds
     """
     v_sphere.logger.info(f"VSphere: Checking on status of task {task}")
-    seconds_waited = 0
-    while task.info.state not in [vim.TaskInfo.State.success, vim.TaskInfo.State.error]:
-        v_sphere.logger.info(f" VSphere: Waiting for {task} to complete.")
-        time.sleep(10)
-        seconds_waited += 10
-        if timeout_seconds and timeout_seconds < seconds_waited:
-            raise VMWareTimeout(f"Waited {seconds_waited} seconds for {task} to complete and it didn't!")
-
-    if task.info.state == vim.TaskInfo.State.success:
+
+    state = TaskReaper.get_reaper(v_sphere.get_service_instance()).wait(task, timeout_seconds)
+
+    if state is None:
+        raise VMWareTimeout(f"Waited {timeout_seconds} seconds for {task} to complete and it didn't!")
+
+    if state == vim.TaskInfo.State.success:
         v_sphere.logger.info(f"VSphere: {task} succeeded")
         return True
 
@@ -1,6 +1,8 @@
+import functools
 import unicodedata
 
 
+@functools.lru_cache(maxsize=1024)
 def get_vmware_safe_string(input_str):
     """
     Given a string of characters which may contain accents or other unicode characters, first tries to replace accents
@@ -15,10 +17,16 @@ def get_vmware_safe_string(input_str):
 
     Based on https://stackoverflow.com/a/517974
 
+    Results are cached, as the same names tend to get written to lots of VMs.
+
     :param str input_str:
     :return: string safe to write to VMWare
     :rtype str:
     """
+    # Nothing to strip, so skip the normalisation entirely
+    if input_str.isascii():
+        return input_str
+
     nfkd_form = unicodedata.normalize('NFKD', input_str)
     only_ascii = nfkd_form.encode('ASCII', 'ignore')
-    return only_ascii.decode("utf-8")
+    return only_ascii.decode("ascii")
@@ -1,16 +1,26 @@
 import atexit
+import json
+import os
 import ssl
+import threading
+import time
 
 from pyVim import connect
 from pyVmomi import vim
 
-from const import VM_POWER_STATE_ON, VM_POWER_STATE_OFF
+from const import VM_POWER_STATE_ON, VM_POWER_STATE_OFF, SESSION_FILE_ENV_VAR
 from exceptions import VMWareObjectNotFound, VMWareBadState, VMWareConnectionException
-from support_functions import power_functions, task_functions, search_functions, folder_functions
+from support_functions import power_functions, task_functions, search_functions, folder_functions, \
+    batch_functions
 from support_functions.guest_os_interface import GuestOSInterface
 
 import logging
 
+# vCenters generally have self signed certificates, so we don't verify them. Built once, as it's not cheap.
+_INSECURE_SSL_CONTEXT = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+_INSECURE_SSL_CONTEXT.check_hostname = False
+_INSECURE_SSL_CONTEXT.verify_mode = ssl.CERT_NONE
+
 
 class VSphere:
     """
@@ -19,6 +29,9 @@ class VSphere:
     DEFAULT_PORT = 443
     DEFAULT_LOGGER = logging.getLogger('info')
 
+    # How long a name -> object index for a vimtype is trusted before we fetch the names from vCenter again.
+    NAME_INDEX_TTL_SECONDS = 90
+
     @staticmethod
     def _validate_credentials(credentials):
         """
@@ -32,7 +45,7 @@ class VSphere:
 
         return True
 
-    def __init__(self, uri, username, password, port=DEFAULT_PORT, logger=DEFAULT_LOGGER):
+    def __init__(self, uri, username, password, port=DEFAULT_PORT, logger=DEFAULT_LOGGER, session_file=None):
         """
 
         :param str uri: URL/IP of vSphere to talk to
@@ -40,6 +53,9 @@ class VSphere:
         :param str password: plain text password.
         :param int port: (optional)
         :param logger logger: 
+        :param str session_file: (optional) file to keep the session cookie in, so that later runs can pick the session
+            back up instead of logging in again. Defaults to the VI_SESSIONFILE environment variable, if set. Sessions
+            are stored per vCenter and user, so one file can be shared by several VSpheres.
         """
         # Main class vars
         self.uri = uri
@@ -47,11 +63,20 @@ class VSphere:
         self._username = username
         self._password = password
         self.logger = logger
+        self.session_file = session_file or os.environ.get(SESSION_FILE_ENV_VAR)
 
         # These are set up here and will be optionally populated on use
+        self._guest_ops_manager = None
         self._process_manager = None
         self._file_manager = None
         self.vmw_objs = {}
+        self._name_index = {}
+        self._uuid_index = {}
+        self._custom_field_index = None
+        self._power_state_watcher = None
+        self._power_state_watcher_lock = threading.RLock()
+        self._session_cookie = None
+        self._disconnect_registered = False
 
         # Try to Connect
         self._service_instance = self._connect()
@@ -64,25 +89,233 @@ class VSphere:
         :rtype vim.ServiceInstance:
         """
 
-        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
-        context.verify_mode = ssl.CERT_NONE
+        service_instance = self._resume_session()
+        if service_instance:
+            return service_instance
 
-        self.logger.info(f" VSphere: Connecting to vSphere at {self.uri}")
+        self.logger.info(" VSphere: Connecting to vSphere at %s", self.uri)
 
         try:
             service_instance = connect.SmartConnect(host=self.uri,
                                                     user=self._username,
                                                     pwd=self._password,
                                                     port=self.port,
-                                                    sslContext=context)
+                                                    sslContext=_INSECURE_SSL_CONTEXT)
         except Exception as error:
             raise VMWareConnectionException(f'Could not connect to vCentre: {self.uri} reason given {error}')
 
-        atexit.register(self.logger.info, f" VSphere: Disconnecting from vSphere")
-        atexit.register(connect.Disconnect, service_instance)
+        self._session_cookie = service_instance._stub.cookie
+
+        if self.session_file:
+            self._save_session(service_instance)
+
+        # Only the once, however many times we reconnect. _disconnect() logs out of whichever session is current.
+        if not self._disconnect_registered:
+            atexit.register(self._disconnect)
+            self._disconnect_registered = True
 
         return service_instance
 
+    def _disconnect(self):
+        """
+        Log out of the current session when the program exits. If we're saving the session to reuse next time,
+        logging out would kill it, so we leave it to expire on its own.
+
+        :return:
+        """
+        if self.session_file or not self._service_instance:
+            return
+
+        self.logger.info(" VSphere: Disconnecting from vSphere")
+        connect.Disconnect(self._service_instance)
+
+    def disconnect(self, logout=True):
+        """
+        Log out of vSphere now, rather than waiting for the program to exit. Use this when you're done with a VSphere
+        in a long running program, so its exit handler (and with it, this object) isn't kept around until exit.
+
+        If we're saving the session to self.session_file, logging out also removes it from the file. To keep it for
+        the next run instead, pass logout=False: we stop using the session, but it's left to expire on its own.
+
+        If the VSphere is used again afterwards, it looks everything up afresh, with a new session (or, if we didn't
+        log out, the saved one).
+
+        :param bool logout: (optional) set to False to leave a saved session logged in
+        :return:
+        """
+        if self._disconnect_registered:
+            atexit.unregister(self._disconnect)
+            self._disconnect_registered = False
+
+        if self._service_instance:
+            self._close_session_objects()
+
+            if logout:
+                self.logger.info(" VSphere: Disconnecting from vSphere")
+                connect.Disconnect(self._service_instance)
+                if self.session_file:
+                    self._forget_saved_session()
+
+        self._service_instance = None
+        self._session_cookie = None
+
+    def _close_session_objects(self):
+        """
+        Clean up everything tied to the current session: close the views, reaper and watcher we have open on vCenter,
+        and forget the managed objects we've cached, as they can't be used with any other session. Anything we need
+        after this is looked up again with the next session.
+
+        :return:
+        """
+        search_functions.close_all_views(self._service_instance)
+        task_functions.TaskReaper.close_reaper(self._service_instance)
+        self._close_power_state_watcher()
+
+        self._guest_ops_manager = None
+        self._process_manager = None
+        self._file_manager = None
+        self.vmw_objs = {}
+        self._name_index = {}
+        self._uuid_index = {}
+        self._custom_field_index = None
+
+    def _resume_session(self):
+        """
+        Try to pick up an existing session rather than logging in again. That's either the session we already had (when
+        reconnecting) or one saved in self.session_file by an earlier run.
+
+        The session is only used if vCenter says it belongs to the user we were asked to connect as.
+
+        :return: a service instance using the existing session, or None if there isn't a usable one.
+        :rtype vim.ServiceInstance:
+        """
+        cookie = self._session_cookie
+        if not cookie and self.session_file:
+            cookie = self._read_saved_sessions().get(self._session_key())
+
+        if not cookie:
+            return None
+
+        try:
+            stub = connect.SmartStubAdapter(host=self.uri, port=self.port, sslContext=_INSECURE_SSL_CONTEXT)
+            stub.cookie = cookie
+            service_instance = vim.ServiceInstance('ServiceInstance', stub)
+
+            # There's no session if it expired or was logged out, in which case we'll have to log in again.
+            current_session = service_instance.content.sessionManager.currentSession
+            if current_session is None:
+                self.logger.info(" VSphere: Existing session for %s has expired", self.uri)
+                self._session_cookie = None
+                return None
+
+            if not self._is_our_user(current_session.userName):
+                self.logger.info(" VSphere: Existing session for %s belongs to %s, not %s", self.uri,
+                                 current_session.userName, self._username)
+                self._session_cookie = None
+                return None
+
+        except Exception as error:
+            self.logger.info(" VSphere: Could not reuse existing session for %s, reason given %s", self.uri, error)
+            self._session_cookie = None
+            return None
+
+        self.logger.info(" VSphere: Reusing existing session for vSphere at %s", self.uri)
+        self._session_cookie = cookie
+        return service_instance
+
+    def _session_key(self):
+        """
+        What our session is saved under in self.session_file.
+
+        :rtype str:
+        """
+        return f"{self._username}@{self.uri}:{self.port}"
+
+    def _is_our_user(self, session_username):
+        """
+        Whether a session's user is the one we were asked to connect as. vCenter may report 'user@domain' as
+        'DOMAIN\\user', so both are compared in the 'user@domain' form, ignoring case.
+
+        :param str session_username: the userName vCenter gives for the session
+        :rtype bool:
+        """
+        def normalise(username):
+            username = username.lower()
+            if '\\' in username:
+                domain, username = username.split('\\', 1)
+                username = f"{username}@{domain}"
+            return username
+
+        session_username = normalise(session_username)
+        username = normalise(self._username)
+
+        # A user given without a domain matches that user in whichever domain vCenter put it in
+        if '@' not in username:
+            session_username = session_username.split('@', 1)[0]
+
+        return session_username == username
+
+    def _read_saved_sessions(self):
+        """
+        Read the saved sessions from self.session_file.
+
+        :return: the saved session cookies. Empty if there's no file, or it can't be read.
+        :rtype dict: {session key: cookie}, see _session_key()
+        """
+        if not os.path.isfile(self.session_file):
+            return {}
+
+        try:
+            with open(self.session_file) as session_file:
+                saved_sessions = json.load(session_file)
+        except (OSError, ValueError) as error:
+            self.logger.info(" VSphere: Could not read saved sessions from %s, reason given %s", self.session_file,
+                             error)
+            return {}
+
+        return saved_sessions if isinstance(saved_sessions, dict) else {}
+
+    def _save_session(self, service_instance):
+        """
+        Write the session cookie out to self.session_file (readable only by us) for the next run to reuse, alongside
+        any sessions saved there for other vCenters or users.
+
+        :param vim.ServiceInstance service_instance:
+        :return:
+        """
+        saved_sessions = self._read_saved_sessions()
+        saved_sessions[self._session_key()] = service_instance._stub.cookie
+        self._write_saved_sessions(saved_sessions)
+
+    def _forget_saved_session(self):
+        """
+        Remove our session from self.session_file, e.g. because we've logged out of it.
+
+        :return:
+        """
+        saved_sessions = self._read_saved_sessions()
+        if saved_sessions.pop(self._session_key(), None):
+            self._write_saved_sessions(saved_sessions)
+
+    def _write_saved_sessions(self, saved_sessions):
+        """
+        Write out self.session_file (readable only by us).
+
+        :param dict saved_sessions: {session key: cookie}, see _session_key()
+        :return:
+        """
+        # Write to a temporary file and move it into place, so nobody reads a half written file.
+        temp_file = f"{self.session_file}.{os.getpid()}.tmp"
+        try:
+            session_fd = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(session_fd, 'w') as session_file:
+                json.dump(saved_sessions, session_file)
+
+            os.replace(temp_file, self.session_file)
+
+        except OSError as error:
+            self.logger.error(" VSphere: Could not save session to %s, reason given %s", self.session_file, error)
+
     def get_service_instance(self, force_refresh=False):
         """
         Fetch the vmware service instance for interacting with the SOAP API. If there isn't one, gets one.
@@ -95,6 +328,9 @@ class VSphere:
         :rtype vim.ServiceInstance:
         """
         if not self._service_instance or force_refresh:
+            if self._service_instance:
+                self._close_session_objects()
+
             self._service_instance = self._connect()
 
         return self._service_instance
@@ -108,8 +344,7 @@ class VSphere:
         """
 
         if not self._process_manager or force_refresh:
-            service_instance = self.get_service_instance(force_refresh)
-            self._process_manager = service_instance.vmw_content.guestOperationsManager.processManager
+            self._process_manager = self._get_guest_ops_manager(force_refresh).processManager
 
         return self._process_manager
 
@@ -122,11 +357,38 @@ class VSphere:
         :return:
         """
         if not self._file_manager or force_refresh:
-            service_instance = self.get_service_instance(force_refresh)
-            self._file_manager = service_instance.vmw_content.guestOperationsManager.fileManager
+            self._file_manager = self._get_guest_ops_manager(force_refresh).fileManager
 
         return self._file_manager
 
+    def _get_guest_ops_manager(self, force_refresh=False):
+        """
+        Returns the VMWare guestOperationsManager, which the processManager and fileManager hang off, so they only
+        need to look it up once between them.
+
+        :param bool force_refresh: (optional) if set to True, gets a new guestOperationsManager and service instance.
+        :return:
+        """
+        if not self._guest_ops_manager or force_refresh:
+            service_instance = self.get_service_instance(force_refresh)
+            self._guest_ops_manager = service_instance.content.guestOperationsManager
+
+        return self._guest_ops_manager
+
+    @property
+    def process_manager(self):
+        """
+        The (cached) VMWare processManager. See get_process_manager()
+        """
+        return self.get_process_manager()
+
+    @property
+    def file_manager(self):
+        """
+        The (cached) VMWare fileManager. See get_file_manager()
+        """
+        return self.get_file_manager()
+
     def load_vmw_obj_by_name(self, vimtype, name):
         """
         Searches vCenter for an object of the given type and name and loads it into self.vmw_objs
@@ -139,21 +401,84 @@ class VSphere:
         :rtype vim.ManagedObject: Return a vmware object of the given vimtype
         :raises VMWareObjectNotFound: No object of that name + type in VMWare.
         """
-        vmw_data = search_functions.get_vmw_objects_of_type(self.get_service_instance(), vimtype)
+        name_index = self._get_cached_name_index(vimtype)
+        if name_index is None:
+            # A freshly built index has every name in it, so if the name's not there, there's no such object
+            vmw_obj = self._get_name_index(vimtype).get(name)
+        else:
+            vmw_obj = name_index.get(name)
 
-        for result in vmw_data:
-            if result["name"] == name:
-                vmw_obj = result["obj"]
-                self.vmw_objs[name] = vmw_obj
-                return vmw_obj
+            # Not in the index, but it might have been created since we built it
+            if not vmw_obj:
+                vmw_obj = search_functions.find_vmw_obj_by_name(self.get_service_instance(), vimtype, name)
+
+        if vmw_obj:
+            self.vmw_objs[(vimtype, name)] = vmw_obj
+            return vmw_obj
 
         raise VMWareObjectNotFound(f"Could not find {vimtype} with name {name}!")
 
+    def _get_name_index(self, vimtype):
+        """
+        Get a dict of name -> object for every object of the given vimtype, so repeated lookups of different names
+        cost one fetch of all the names (rather than one each). The index is rebuilt after NAME_INDEX_TTL_SECONDS, or
+        when something we did invalidates it, see _invalidate_name_index().
+
+        :param class vimtype:
+        :return:
+        :rtype dict: {str: vim.ManagedObject}
+        """
+        name_index = self._get_cached_name_index(vimtype)
+        if name_index is None:
+            vmw_data = search_functions.get_vmw_objects_of_type(self.get_service_instance(), vimtype,
+                                                                path_set=['name'])
+            name_index = self._store_name_index(vimtype, vmw_data)
+
+        return name_index
+
+    def _get_cached_name_index(self, vimtype):
+        """
+        Get the name index for a vimtype, if we have one that's still fresh. See _get_name_index().
+
+        :param class vimtype:
+        :return: the index, or None if it needs building (again)
+        :rtype dict: {str: vim.ManagedObject}
+        """
+        built_at, name_index = self._name_index.get(vimtype, (None, None))
+        if name_index is None or time.monotonic() - built_at > self.NAME_INDEX_TTL_SECONDS:
+            return None
+
+        return name_index
+
+    def _store_name_index(self, vimtype, vmw_data):
+        """
+        Build and store the name index for a vimtype from the names of all the objects of that type.
+
+        :param class vimtype:
+        :param list(dict) vmw_data: results from search_functions, with 'name' and 'obj' for every object of vimtype
+        :return: the new index
+        :rtype dict: {str: vim.ManagedObject}
+        """
+        name_index = {result['name']: result['obj'] for result in vmw_data if 'name' in result}
+        self._name_index[vimtype] = (time.monotonic(), name_index)
+        return name_index
+
+    def _invalidate_name_index(self, vimtype):
+        """
+        Forget the name index for a vimtype, because we've just created or destroyed something of that type.
+
+        :param class vimtype:
+        :return:
+        """
+        self._name_index.pop(vimtype, None)
+
     def get_vmw_obj_by_name(self, vimtype, name):
         """
-        Get the vsphere object associated with a given text name. If we already have a copy in self.vmw_objects,
+        Get the vsphere object associated with a given text name. If we already have a copy in self.vmw_objs,
         we return that. Otherwise we go looking for it.
 
+        self.vmw_objs is keyed by (vimtype, name), as VMWare is quite happy for e.g. a VM and a folder to share a name.
+
         :note: Pretty sure the container view search logic here came from the community samples, but I can't find the
         original source.
 
@@ -165,31 +490,156 @@ class VSphere:
         :raises VMWareObjectNotFound: No object of that name + type in VMWare.
         """
 
-        vmw_obj = self.vmw_objs.get(name)
-        if vmw_obj:
-            if type(vmw_obj) == vimtype:
-                return vmw_obj
+        vmw_obj = self.vmw_objs.get((vimtype, name))
+        if isinstance(vmw_obj, vimtype):
+            return vmw_obj
+
+        return self.load_vmw_obj_by_name(vimtype, name)
+
+    def get_vmw_obj_by_path(self, vimtype, inv_path):
+        """
+        Get a VMWare object by its inventory path, e.g. 'my-datacenter/vm/some/folder/my-vm'. vCenter walks the path
+        itself, so unlike a search by name this doesn't fetch every object of the type. The object is cached in
+        self.vmw_objs under its path.
+
+        :param class vimtype: vim.XXXX vim class of the object to retrieve. E.g. vim.VirtualMachine
+        :param str inv_path: inventory path of the object
+        :return:
+        :rtype vim.ManagedObject: Managed object, specifically of vimtype
+        :raises VMWareObjectNotFound: No object of that type at that path.
+        """
+        vmw_obj = self.vmw_objs.get((vimtype, inv_path))
+        if isinstance(vmw_obj, vimtype):
+            return vmw_obj
+
+        search_index = self.get_service_instance().content.searchIndex
+        vmw_obj = search_index.FindByInventoryPath(inv_path)
+
+        if isinstance(vmw_obj, vimtype):
+            self.vmw_objs[(vimtype, inv_path)] = vmw_obj
+            return vmw_obj
+
+        raise VMWareObjectNotFound(f"Could not find {vimtype} at path {inv_path}!")
+
+    def get_vm_by_path(self, inv_path):
+        return self.get_vmw_obj_by_path(vim.VirtualMachine, inv_path)
+
+    def get_folder_by_path(self, inv_path):
+        return self.get_vmw_obj_by_path(vim.Folder, inv_path)
+
+    @staticmethod
+    def _is_inventory_path(name):
+        """
+        VMWare escapes any '/' in an object's name (as %2f), so a name with a '/' in it must be an inventory path.
+
+        :param str name:
+        :rtype bool:
+        """
+        return '/' in name
+
+    def _get_vmw_obj_by_name_or_path(self, vimtype, name_or_path):
+        """
+        Get a VMWare object by inventory path if we were given one, otherwise by name.
+
+        :param class vimtype:
+        :param str name_or_path:
+        :return:
+        :rtype vim.ManagedObject:
+        :raises VMWareObjectNotFound: No object of that name/path + type in VMWare.
+        """
+        if self._is_inventory_path(name_or_path):
+            return self.get_vmw_obj_by_path(vimtype, name_or_path)
+
+        return self.get_vmw_obj_by_name(vimtype, name_or_path)
+
+    def _batch_lookup(self, specs):
+        """
+        Get several objects, of various types, by name. Anything not already in self.vmw_objs is looked for in the
+        name indexes (see _get_name_index()). For any types we don't have a fresh index of, the names are fetched in one
+        go, using a single view and property collection across all those types, and used to build their indexes.
+
+        Any names which are inventory paths are looked up directly by path instead, see get_vmw_obj_by_path().
+
+        :param list(tuple) specs: (vimtype, name) pairs, e.g. [(vim.HostSystem, 'esx01'), (vim.Datastore, 'ds01')]
+        :return: the objects found, keyed by the (vimtype, name) pair asked for
+        :rtype dict: {(class, str): vim.ManagedObject}
+        :raises VMWareObjectNotFound: if any of the objects couldn't be found.
+        """
+        found = {}
+        missing = []
+        for vimtype, name in specs:
+            if self._is_inventory_path(name):
+                found[(vimtype, name)] = self.get_vmw_obj_by_path(vimtype, name)
+                continue
+
+            vmw_obj = self.vmw_objs.get((vimtype, name))
+            if isinstance(vmw_obj, vimtype):
+                found[(vimtype, name)] = vmw_obj
             else:
-                raise TypeError(f"Requested vmw object of type {vimtype}, got {vmw_obj}")
+                missing.append((vimtype, name))
 
-        else:
-            return self.load_vmw_obj_by_name(vimtype, name)
+        if not missing:
+            return found
+
+        name_indexes = {}
+        for vimtype, _ in missing:
+            if vimtype not in name_indexes:
+                name_indexes[vimtype] = self._get_cached_name_index(vimtype)
+
+        # Fetch the names for every type we don't have an index of in one go
+        unindexed_vimtypes = [vimtype for vimtype, name_index in name_indexes.items() if name_index is None]
+        if unindexed_vimtypes:
+            vmw_data = search_functions.get_vmw_objects_of_types(self.get_service_instance(), unindexed_vimtypes,
+                                                                 path_set=['name'])
+            for vimtype in unindexed_vimtypes:
+                name_indexes[vimtype] = self._store_name_index(vimtype, vmw_data[vimtype])
+
+        for vimtype, name in missing:
+            vmw_obj = name_indexes[vimtype].get(name)
 
-    def get_vmw_obj_by_uuid(self, uuid):
+            # Not in an index we had already, but it might have been created since we built it
+            if not vmw_obj and vimtype not in unindexed_vimtypes:
+                vmw_obj = search_functions.find_vmw_obj_by_name(self.get_service_instance(), vimtype, name)
+
+            if not vmw_obj:
+                raise VMWareObjectNotFound(f"Could not find {vimtype} with name {name}!")
+
+            found[(vimtype, name)] = vmw_obj
+            self.vmw_objs[(vimtype, name)] = vmw_obj
+
+        return found
+
+    def _fetch_props(self, vmw_obj, path_set):
+        """
+        Fetch only the given properties of a VMWare object, see search_functions.fetch_properties()
+
+        :param vim.ManagedObject vmw_obj:
+        :param list path_set:
+        :return:
+        :rtype dict: {property path: value}
+        """
+        return search_functions.fetch_properties(self.get_service_instance(), vmw_obj, path_set)
+
+    def get_vmw_obj_by_uuid(self, uuid, force_refresh=False):
         """
         Find a VMWare object by UUID. The object will be added to the vmw_objs
-        list (indexed by its name).
+        list (indexed by its type and name). UUIDs we've already looked up are answered from a cache.
 
         :param str uuid:
+        :param bool force_refresh: (optional) set to True to always get a fresh object from vCenter
         :return:
         :rtype vim.ManagedObject:
         :raises VMWareObjectNotFound: No resource with that UUID.
         """
+        if not force_refresh and uuid in self._uuid_index:
+            return self._uuid_index[uuid]
+
         search_index = self.get_service_instance().content.searchIndex
         vmw_obj = search_index.FindByUuid(None, uuid, True, False)
 
         if vmw_obj:
-            self.vmw_objs[vmw_obj.name] = vmw_obj
+            self._uuid_index[uuid] = vmw_obj
+            self.vmw_objs[(vim.VirtualMachine, vmw_obj.name)] = vmw_obj
             return vmw_obj
 
         raise VMWareObjectNotFound(f"No result for {uuid}")
@@ -223,32 +673,38 @@ class VSphere:
         host, as well as the VM Folder to put it into and the name to assign it, this function asks vSphere for
         these objects and builds a clonespec which is then run to create the VM.
 
-        :param str template_name:
-        :param str target_host_name:
-        :param str target_datastore_name:
-        :param str target_folder_name:
+        If you know where they live, the template and folder (or any of the others) can be given as inventory paths
+        instead of names, e.g. 'my-datacenter/vm/templates/my-template'. These are found directly, without searching
+        through every object of that type.
+
+        :param str template_name: name or inventory path
+        :param str target_host_name: name or inventory path
+        :param str target_datastore_name: name or inventory path
+        :param str target_folder_name: name or inventory path
         :param str new_vm_name:
         :return: None
         :raises VMWareBadState: if there is a problem with things in VMWare which prevents us proceeding
         :raises VMWareObjectNotFound: if we can't find required objects in VMWare.
         """
 
-        self.logger.info(f" VSphere: Getting ready to clone VM {template_name}")
-
-        vmw_vm_template = self.get_vmw_obj_by_name(vim.VirtualMachine, template_name)
-
-        self.logger.info(f" VSphere: Looking for VM Host {target_host_name}")
-        vmw_host = self.get_vmw_obj_by_name(vim.HostSystem, target_host_name)
+        self.logger.info(" VSphere: Getting ready to clone VM %s", template_name)
+
+        self.logger.info(" VSphere: Looking for VM Host %s, VMware Datastore %s and VM Folder %s",
+                         target_host_name, target_datastore_name, target_folder_name)
+        vmw_objs = self._batch_lookup([
+            (vim.VirtualMachine, template_name),
+            (vim.HostSystem, target_host_name),
+            (vim.Datastore, target_datastore_name),
+            (vim.Folder, target_folder_name),
+        ])
+        vmw_vm_template = vmw_objs[(vim.VirtualMachine, template_name)]
+        vmw_host = vmw_objs[(vim.HostSystem, target_host_name)]
+        vmw_datastore = vmw_objs[(vim.Datastore, target_datastore_name)]
+        vmw_folder = vmw_objs[(vim.Folder, target_folder_name)]
 
         if vmw_host.summary.runtime.inMaintenanceMode:
             raise VMWareBadState("Target host is in Maintanence Mode! Can't deploy there!")
 
-        self.logger.info(f" VSphere: Looking for VMware Datastore {target_datastore_name}")
-        vmw_datastore = self.get_vmw_obj_by_name(vim.Datastore, target_datastore_name)
-
-        self.logger.info(f" VSphere: Looking for VM Folder {target_folder_name}")
-        vmw_folder = self.get_vmw_obj_by_name(vim.Folder, target_folder_name)
-
         self.logger.info(" VSphere: Building clone specification")
         # Relocation spec - where the VM will be stored and hosted
         relospec = vim.vm.RelocateSpec()
@@ -262,17 +718,21 @@ class VSphere:
         clonespec.powerOn = False
         clonespec.template = False
 
-        self.logger.info(f" VSphere: Cloning {new_vm_name} to {vmw_folder} on {vmw_host}. This will take some time...")
+        # Log the names we were given rather than the managed objects, which might have to go to vCenter to describe
+        # themselves.
+        self.logger.info(" VSphere: Cloning %s to %s on %s. This will take some time...", new_vm_name,
+                         target_folder_name, target_host_name)
         try:
             task = vmw_vm_template.Clone(folder=vmw_folder, name=new_vm_name, spec=clonespec)
         except vim.fault.NoPermission as e:
             raise VMWareBadState(f"Permissions Error: Not allowed to clone VM template! Err: {str(e)}")
 
         result = task_functions.wait_for_task_complete(self, task)
+        self._invalidate_name_index(vim.VirtualMachine)
         if not result:
             raise VMWareBadState(f"VMWare failed to clone the VM! Check the vSphere logs.")
 
-        self.logger.info(f" VSphere: Congratulations! It's a Virtual Machine!")
+        self.logger.info(" VSphere: Congratulations! It's a Virtual Machine!")
 
     def configure_machine(self, vm_name, vm_network_name, hardware_specs):
         """
@@ -291,10 +751,13 @@ class VSphere:
         requested_memory = int(hardware_specs['memory'])
         requested_hdd = int(hardware_specs['hdd'])
 
-        vmw_vm = self.get_vmw_obj_by_name(vim.VirtualMachine, vm_name)
+        self.logger.info(" VSphere: Looking for VMware Network %s", vm_network_name)
+        vmw_objs = self._batch_lookup([(vim.VirtualMachine, vm_name), (vim.Network, vm_network_name)])
+        vmw_vm = vmw_objs[(vim.VirtualMachine, vm_name)]
+        vmw_network = vmw_objs[(vim.Network, vm_network_name)]
 
-        self.logger.info(f" VSphere: Looking for VMware Network {vm_network_name}")
-        vmw_network = self.get_vmw_obj_by_name(vim.Network, vm_network_name)
+        # The NIC wants the network's name, not the path we might have been given to find it by
+        network_name = vmw_network.name if self._is_inventory_path(vm_network_name) else vm_network_name
 
         devices = []
 
@@ -307,10 +770,10 @@ class VSphere:
         nic.device.key = 4000
         nic.device.deviceInfo = vim.Description()
         nic.device.deviceInfo.label = "Network Adapter"
-        nic.device.deviceInfo.summary = vmw_network.name
+        nic.device.deviceInfo.summary = network_name
         nic.device.backing = vim.vm.device.VirtualEthernetCard.NetworkBackingInfo()
         nic.device.backing.network = vmw_network
-        nic.device.backing.deviceName = vmw_network.name
+        nic.device.backing.deviceName = network_name
         nic.device.backing.useAutoDetect = False
         nic.device.connectable = vim.vm.device.VirtualDevice.ConnectInfo()
         nic.device.connectable.startConnected = True
@@ -318,22 +781,21 @@ class VSphere:
         devices.append(nic)
 
         # Dealing with template disk size
-        try:
-            template_disk = [x for x in vmw_vm.config.hardware.device
-                             if isinstance(x, vim.vm.device.VirtualDisk)][0]
-        except IndexError:
-            raise VMWareBadState("Somehow this VM {vm} has no discs. Cannot resize!")
+        devices_prop = self._fetch_props(vmw_vm, ['config.hardware.device']).get('config.hardware.device', [])
+        template_disk = next((device for device in devices_prop if isinstance(device, vim.vm.device.VirtualDisk)),
+                             None)
+        if template_disk is None:
+            raise VMWareBadState(f"Somehow this VM {vm_name} has no discs. Cannot resize!")
 
-        template_disk_size_kb = int(
-            template_disk.deviceInfo.summary.split(" ")[0].replace(",", "").replace(".", ""))
+        template_disk_size_kb = template_disk.capacityInKB
 
         # Annoyingly VMWare works in Kb
         requested_hdd_kb = requested_hdd * 1024 * 1024
 
         if requested_hdd_kb > template_disk_size_kb:
             # Need to resize the disk
-            self.logger.info(f" VSphere: increasing disk size to {requested_hdd_kb} KB as it's bigger than the template "
-                  f"size ({template_disk_size_kb} KB)")
+            self.logger.info(" VSphere: increasing disk size to %s KB as it's bigger than the template size (%s KB)",
+                             requested_hdd_kb, template_disk_size_kb)
 
             virtual_disk_spec = vim.vm.device.VirtualDeviceSpec()
             virtual_disk_spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.edit
@@ -343,7 +805,7 @@ class VSphere:
             new_disk_size_kb = requested_hdd_kb
         else:
             new_disk_size_kb = template_disk_size_kb
-            self.logger.info(f" VSphere: requested disc size is equal to or smaller than the template. Not resizing disc")
+            self.logger.info(" VSphere: requested disc size is equal to or smaller than the template. Not resizing disc")
 
 
         # Set VM Hardware config spec
@@ -355,7 +817,8 @@ class VSphere:
         new_spec.deviceChange = devices
 
         # Do the HW reconfiguration
-        self.logger.info(f" VSphere: Reconfiguring hardware: Num CPUs: '{requested_vcpus}' Mem (MB): '{requested_memory}'")
+        self.logger.info(" VSphere: Reconfiguring hardware: Num CPUs: '%s' Mem (MB): '%s'", requested_vcpus,
+                         requested_memory)
 
         task = vmw_vm.ReconfigVM_Task(spec=new_spec)
 
@@ -364,18 +827,65 @@ class VSphere:
         if not success:
             raise VMWareBadState("VMWare failed to reconfigure the VM! Check the vSphere logs.")
 
-        self.logger.info(f" VSphere: VM {vm_name} should now have the correct hardware specs")
+        self.logger.info(" VSphere: VM %s should now have the correct hardware specs", vm_name)
 
     def get_vm_power_state(self, vm_name):
         """
         Fetch the power state of the VM as reported by VMWare, this will be a string like "PoweredOn".
 
+        The first check of a VM subscribes to its power state changes, which costs a little more than a one off fetch
+        would, but later checks don't go to vCenter at all. See power_functions.PowerStateWatcher.
+
         :param vm_name:
         :return:
         :rtype string:
         """
         vmw_vm = self.get_vm(vm_name)
-        return vmw_vm.summary.runtime.powerState
+        return self._subscribe_power_state(vmw_vm).get_power_state(vmw_vm)
+
+    def _subscribe_power_state(self, vmw_vm):
+        """
+        Have vCenter keep us up to date with the VM's power state from now on, so checking it doesn't cost a SOAP call.
+        See power_functions.PowerStateWatcher.
+
+        :param vim.VirtualMachine vmw_vm:
+        :return: the watcher the VM is subscribed to
+        :rtype power_functions.PowerStateWatcher:
+        """
+        with self._power_state_watcher_lock:
+            watcher = self._power_state_watcher
+            if watcher is None or watcher.error:
+                # A watcher which failed may still have its collector on vCenter
+                if watcher:
+                    watcher.close()
+
+                watcher = power_functions.PowerStateWatcher(self.get_service_instance())
+                self._power_state_watcher = watcher
+
+        watcher.subscribe(vmw_vm)
+        return watcher
+
+    def _unsubscribe_power_state(self, vmw_vm):
+        """
+        Stop watching the VM's power state. We do this after changing it ourselves, so the next check gets the new
+        state straight from vCenter rather than racing the update to the watcher.
+
+        :param vim.VirtualMachine vmw_vm:
+        :return:
+        """
+        if self._power_state_watcher:
+            self._power_state_watcher.unsubscribe(vmw_vm)
+
+    def _close_power_state_watcher(self):
+        """
+        Stop watching power states altogether, e.g. because the session is going away.
+
+        :return:
+        """
+        with self._power_state_watcher_lock:
+            if self._power_state_watcher:
+                self._power_state_watcher.close()
+                self._power_state_watcher = None
 
     def get_vm_is_powered_on(self, vm_name):
         """
@@ -405,6 +915,23 @@ class VSphere:
         """
         vmw_vm = self.get_vm(vm_name)
         power_functions.power_on_vm_and_wait_for_os(self, vmw_vm)
+        self._unsubscribe_power_state(vmw_vm)
+
+    def power_on_vms_and_wait_for_os(self, vm_names, max_workers=32):
+        """
+        Given a list of VM names, switches them all on at once. Returns when every OS is responding, or has failed to.
+
+        :param list(str) vm_names:
+        :param int max_workers: (optional) how many VMs to power on at the same time
+        :return: the exception raised for each VM which failed to come up. Empty if they all came up.
+        :rtype dict: {str: Exception}
+        """
+        vmw_vms = {self.get_vm(vm_name): vm_name for vm_name in vm_names}
+        results = batch_functions.batch_power_on(self, list(vmw_vms), max_workers)
+        for vmw_vm in vmw_vms:
+            self._unsubscribe_power_state(vmw_vm)
+
+        return {vmw_vms[vmw_vm]: error for vmw_vm, error in results.items() if error}
 
     def power_off_vm_soft(self, vm_name):
         """
@@ -416,6 +943,7 @@ class VSphere:
         """
         vmw_vm = self.get_vm(vm_name)
         power_functions.power_off_vm_soft(self, vmw_vm)
+        self._unsubscribe_power_state(vmw_vm)
 
     def power_off_vm_hard(self, vm_name):
         """
@@ -427,6 +955,7 @@ class VSphere:
         """
         vmw_vm = self.get_vm(vm_name)
         power_functions.power_off_vm_hard(self, vmw_vm)
+        self._unsubscribe_power_state(vmw_vm)
 
     def restart_vm_soft(self, vm_name):
         """
@@ -441,6 +970,7 @@ class VSphere:
         """
         vmw_vm = self.get_vm(vm_name)
         power_functions.restart_vm_soft_and_wait_for_tools(self, vmw_vm)
+        self._unsubscribe_power_state(vmw_vm)
 
     def restart_vm_hard(self, vm_name):
         """
@@ -452,6 +982,7 @@ class VSphere:
         """
         vmw_vm = self.get_vm(vm_name)
         power_functions.restart_vm_hard(self, vmw_vm)
+        self._unsubscribe_power_state(vmw_vm)
 
     def destroy_vm(self, vm_name):
         """
@@ -462,13 +993,22 @@ class VSphere:
         :raises VMWareTimeout: Took too long to complete
         :return:
         """
-        if not self.get_vm_is_powered_off(vm_name):
-            self.power_off_vm_hard(vm_name)
-
         vmw_vm = self.get_vm(vm_name)
+
+        # Only fetch the two properties we need, rather than the whole of summary and config
+        vm_props = self._fetch_props(vmw_vm, ['runtime.powerState', 'config.uuid'])
+
+        if vm_props.get('runtime.powerState') != VM_POWER_STATE_OFF:
+            power_functions.power_off_vm_hard(self, vmw_vm)
+
         task = vmw_vm.Destroy_Task()
         task_functions.wait_for_task_complete(self, task, 10)
 
+        self.vmw_objs.pop((vim.VirtualMachine, vm_name), None)
+        self._uuid_index.pop(vm_props.get('config.uuid'), None)
+        self._unsubscribe_power_state(vmw_vm)
+        self._invalidate_name_index(vim.VirtualMachine)
+
 
     def update_vm_custom_fields(self, vm_name, field_name, field_value):
         """
@@ -499,25 +1039,20 @@ class VSphere:
             try:
                 # for all other (non-Notes) customfields, we instead dump the values
                 # into vcenter's customfields
-                available_vm_fields = vmw_vm.availableField
-                target = False
-
-                # find or make fields object with fuzzy match for email and account
-                if "email" in field_name.lower():
-                    for vm_field in available_vm_fields:
-                        if "email" in vm_field.name.lower():
-                            target = vm_field
-                            break
-                elif "account" in field_name.lower():
-                    for vm_field in available_vm_fields:
-                        if "account" in vm_field.name.lower():
-                            target = vm_field
-                            break
-                else:
-                    for vm_field in available_vm_fields:
-                        if field_name.lower() == vm_field.name.lower():
-                            target = vm_field
-                            break
+                key = field_name.lower()
+                needle = next((fuzzy for fuzzy in ("email", "account") if fuzzy in key), None)
+
+                def find_field(custom_field_index):
+                    # find fields object with fuzzy match for email and account
+                    if needle:
+                        return next((field for name, field in custom_field_index.items() if needle in name), None)
+                    return custom_field_index.get(key)
+
+                target = find_field(self._get_custom_field_index())
+
+                # Somebody else may have added the field since we built the index, so check again before making it
+                if not target:
+                    target = find_field(self._get_custom_field_index(force_refresh=True))
 
                 # if we couldn't find the target field, then create it - iff we want
                 # to put a value into it
@@ -526,6 +1061,7 @@ class VSphere:
                         name=field_name,
                         moType=vim.VirtualMachine
                     )
+                    self._custom_field_index[target.name.lower()] = target
 
                 self._service_instance.content.customFieldsManager.SetField(
                     entity=vmw_vm,
@@ -535,6 +1071,26 @@ class VSphere:
             except Exception as e:
                 raise VMWareBadState(f"Couldn't add or update custom field due to error: {str(e)}")
 
+    def _get_custom_field_index(self, force_refresh=False):
+        """
+        Get the custom fields available on VMs, keyed by their lower cased name. These rarely change, so we fetch them
+        from the vCenter's customFieldsManager once, rather than reading each VM's availableField every time.
+
+        :param bool force_refresh: (optional) set to True to fetch the fields again, e.g. when one we expected is missing
+        :return:
+        :rtype dict: {str: vim.CustomFieldsManager.FieldDef}
+        """
+        if self._custom_field_index is None or force_refresh:
+            fields = self.get_service_instance().content.customFieldsManager.field
+
+            # Fields with no type apply to everything, and fields on a parent type (e.g. ManagedEntity) apply to VMs
+            self._custom_field_index = {
+                field.name.lower(): field for field in fields
+                if field.managedObjectType is None or issubclass(vim.VirtualMachine, field.managedObjectType)
+            }
+
+        return self._custom_field_index
+
     def create_folder(self, parent_folder_name, new_folder_name):
         """
         Create a new VM Folder, requires the name of the folder you want to put it in (parent folder).
@@ -544,18 +1100,19 @@ class VSphere:
         """
         parent_folder = self.get_vm_folder(parent_folder_name)
         folder_functions.create_folder(self, parent_folder, new_folder_name)
+        self._invalidate_name_index(vim.Folder)
 
     def move_vm_to_folder(self, vm_name, target_folder_name):
         """
-        :param str vm_name:
-        :param str target_folder_name:
+        :param str vm_name: name or inventory path, e.g. 'my-datacenter/vm/some/folder/my-vm'
+        :param str target_folder_name: name or inventory path, e.g. 'my-datacenter/vm/some/folder'
         :param VSphere vsphere: Added by the decorator
         :raises VMWareTimeout: Took too long to complete
         :raises VMWareBadState:  Task didn't exit successfully
         :return:
         """
-        vmw_folder = self.get_vm_folder(target_folder_name)
-        vmw_machine = self.get_vm(vm_name)
+        vmw_folder = self._get_vmw_obj_by_name_or_path(vim.Folder, target_folder_name)
+        vmw_machine = self._get_vmw_obj_by_name_or_path(vim.VirtualMachine, vm_name)
         result = folder_functions.move_vm_to_folder(self, vmw_machine, vmw_folder)
 
         if not result: